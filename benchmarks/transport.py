@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Transport benchmarks for the Virtuoso kernel.
+
+Starts 'pyllsim.py', a stand-in for dfII, behind the real PyLL server in a
+scratch Jupyter data directory and drives `VirtuosoShell` through it. For
+every benchmark, the number of round trips per second, the median and 99th
+percentile latency and the throughput of result data are reported.
+
+Usage: python benchmarks/transport.py [--latency S] [--calls N] [--only NAME]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+
+from virtuoso_kernel.timing import format_time  # noqa: E402
+
+SIMULATOR = os.path.join(_root, 'virtuoso_kernel', 'pyll', 'pyllsim.py')
+
+
+def run_cell(size):
+    """
+    A cell whose result is a string of *size* bytes
+    """
+    def _call(shell):
+        shell.run_cell('PyLLSimPayload(%d)' % size)
+        return len(shell.output)
+    return _call
+
+
+def get_matches_attr(shell):
+    """
+    Attribute completion, which always asks dfII
+    """
+    return sum(len(_match) for _match in shell.get_matches('cv->')[0])
+
+
+def get_matches_name(shell):
+    """
+    Name completion, served from the local sorted names
+    """
+    return sum(len(_match) for _match in shell.get_matches('pyllSim12')[0])
+
+
+def get_info(shell):
+    """
+    Help lookup with the info cache cleared, so that dfII is asked every time
+    """
+    shell._info_cache.clear()
+    return len(shell.get_info('dbOpenCellViewByType'))
+
+
+# name, benchmark, share of --calls to make
+BENCHMARKS = [('run_cell 10 B', run_cell(10), 1.0),
+              ('run_cell 64 KiB', run_cell(1 << 16), 0.5),
+              ('run_cell 1 MiB', run_cell(1 << 20), 0.05),
+              ('run_cell 16 MiB (shm)', run_cell(1 << 24), 0.01),
+              ('get_matches cv->', get_matches_attr, 1.0),
+              ('get_matches name', get_matches_name, 1.0),
+              ('get_info', get_info, 1.0)]
+
+
+def percentile(samples, fraction):
+    """
+    Sample below which the given fraction of the sorted samples fall
+    """
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def measure(shell, bench, calls):
+    """
+    Return per-call latencies and bytes received over *calls* calls
+    """
+    for _warmup in range(min(calls, 5)):
+        bench(shell)
+    _latencies = []
+    _bytes = 0
+    for _call in range(calls):
+        _start = time.time()
+        _bytes += bench(shell)
+        _latencies.append(time.time() - _start)
+    return _latencies, _bytes
+
+
+def start_simulator(data_dir, latency):
+    """
+    Start the simulator and wait for its server's connection file
+    """
+    _runtime = os.path.join(data_dir, 'runtime')
+    os.makedirs(_runtime)
+    _sim = subprocess.Popen([sys.executable, SIMULATOR,
+                             '--latency', str(latency)])
+    _conn_file = os.path.join(_runtime, 'virtuoso-pyll.json')
+    _deadline = time.time() + 30
+    while not os.path.exists(_conn_file):
+        if _sim.poll() is not None or time.time() > _deadline:
+            raise RuntimeError('The PyLL server did not start')
+        time.sleep(0.05)
+    return _sim
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Benchmark the kernel '
+                                      'transport against a simulated dfII')
+    _parser.add_argument('--latency', type=float, default=0.0,
+                         help='seconds each simulated evaluation takes')
+    _parser.add_argument('--calls', type=int, default=2000,
+                         help='calls per small-payload benchmark')
+    _parser.add_argument('--only', default='',
+                         help='run benchmarks whose name contains this')
+    _args = _parser.parse_args()
+
+    _data_dir = tempfile.mkdtemp(prefix='pyll-bench-')
+    # Keep the benchmark's server away from a real one
+    os.environ['JUPYTER_DATA_DIR'] = _data_dir
+    _sim = start_simulator(_data_dir, _args.latency)
+    try:
+        from virtuoso_kernel.shell import VirtuosoShell
+        _shell = VirtuosoShell()
+        print('%-24s %7s %10s %10s %10s %10s' %
+              ('benchmark', 'calls', 'calls/s', 'p50', 'p99', 'MB/s'))
+        for _name, _bench, _share in BENCHMARKS:
+            if _args.only not in _name:
+                continue
+            _calls = max(int(_args.calls * _share), 10)
+            _latencies, _bytes = measure(_shell, _bench, _calls)
+            _total = sum(_latencies)
+            _latencies.sort()
+            print('%-24s %7d %10.0f %10s %10s %10.1f' %
+                  (_name, _calls, _calls / _total,
+                   format_time(percentile(_latencies, 0.5)),
+                   format_time(percentile(_latencies, 0.99)),
+                   _bytes / _total / 1e6))
+        _shell._shell.close()
+    finally:
+        _sim.terminate()
+        _sim.wait()
+        shutil.rmtree(_data_dir, True)
+
+
+if __name__ == '__main__':
+    main()
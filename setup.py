@@ -44,10 +44,12 @@ setup(name='virtuoso_kernel',
       #url='',
       packages=['virtuoso_kernel'],
       package_data={'virtuoso_kernel': ['pyll/pyllserver.il',
-                                        'pyll/pyllserver.py']},
+                                        'pyll/pyllserver.py',
+                                        'pyll/pyllsim.py']},
       include_package_data=True,
       cmdclass={'install': install_with_kernelspec},
       install_requires=['colorama>=0.3.3'],
+      extras_require={'numpy': ['numpy'], 'lz4': ['lz4']},
       classifiers = [
           'Framework :: IPython',
           'License :: OSI Approved :: Apache Software License',
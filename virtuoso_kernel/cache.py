@@ -0,0 +1,254 @@
+"""
+Kernel-side caches for Virtuoso queries.
+
+These let the kernel answer frequent front-end requests (completion,
+introspection) without a round trip to dfII, and replay the outputs of
+cells memoized with '%%cache'.
+"""
+import glob
+import hashlib
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class SortedNames(object):
+    """
+    Sorted list of SKILL names for local tab-completion.
+
+    The names beginning with a prefix are a slice of the list, found by
+    bisection.
+    """
+    def __init__(self, words=None):
+        super(SortedNames, self).__init__()
+        self._names = []
+        if words is not None:
+            self.update(words)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, word):
+        _index = bisect_left(self._names, word)
+        return _index < len(self._names) and self._names[_index] == word
+
+    def add(self, word):
+        """
+        Insert a single name
+        """
+        _index = bisect_left(self._names, word)
+        if _index == len(self._names) or self._names[_index] != word:
+            self._names.insert(_index, word)
+
+    def update(self, words):
+        """
+        Insert all names from an iterable
+        """
+        if not self._names:
+            self._names = sorted(set(words))
+            return
+        for _word in words:
+            self.add(_word)
+
+    def clear(self):
+        """
+        Remove all names
+        """
+        self._names = []
+
+    def starts_with(self, prefix):
+        """
+        Return a sorted list of all names beginning with *prefix*
+        """
+        return self._names[bisect_left(self._names, prefix):
+                           bisect_left(self._names, prefix + u'\uffff')]
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least recently used entry.
+    """
+    def __init__(self, maxsize=256):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the entry for *key* and mark it as recently used
+        """
+        try:
+            _value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = _value
+        return _value
+
+    def put(self, key, value):
+        """
+        Insert or refresh an entry, evicting the oldest if full
+        """
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drop the entry for *key*, if any
+        """
+        self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Drop all entries
+        """
+        self._data.clear()
+
+
+def dependency_state(patterns):
+    """
+    Return the modification times of the files matching each glob pattern,
+    as [[pattern, [[path, mtime], ...]], ...], for use in cache keys.
+
+    Patterns that match nothing give an empty list, so a file appearing
+    later changes the state too.
+    """
+    _state = []
+    for _pattern in patterns:
+        _files = []
+        for _path in sorted(glob.glob(os.path.expanduser(_pattern))):
+            try:
+                _files.append([_path, os.stat(_path).st_mtime])
+            except OSError:
+                pass  # Removed since glob() saw it
+        _state.append([_pattern, _files])
+    return _state
+
+
+class ResultCache(object):
+    """
+    Outputs of cells keyed by their code and the state of what they depend
+    on, with an optional lifetime.
+
+    The *maxsize* most recently used entries are kept in memory. Entries put
+    with persist=True are also written to *directory*, which keeps at most
+    *maxsize* of them, so that they survive kernel restarts.
+    """
+    def __init__(self, maxsize=64, directory=None):
+        super(ResultCache, self).__init__()
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        # key -> {'output': text, 'stored': time, 'ttl': seconds or None}
+        self._memory = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self._memory)
+
+    @staticmethod
+    def key(code, dependencies=()):
+        """
+        Hash of *code* and the state of its *dependencies*
+        """
+        return hashlib.sha1(json.dumps([code, list(dependencies)],
+                                       sort_keys=True).encode('utf-8')
+                            ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _load(self, key):
+        # Entry persisted by this or an earlier kernel, or None
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key)) as _file:
+                _entry = json.load(_file)
+            os.utime(self._path(key), None)
+        except (IOError, OSError, ValueError):
+            return None
+        return _entry
+
+    def get(self, key):
+        """
+        Return the live entry for *key*, a dict with the 'output' and the
+        time it was 'stored', or None
+        """
+        _entry = self._memory.get(key)
+        if _entry is None:
+            _entry = self._load(key)
+            if _entry is not None:
+                self._memory.put(key, _entry)
+        if _entry is not None and _entry['ttl'] is not None and \
+                time.time() > _entry['stored'] + _entry['ttl']:
+            self.invalidate(key)
+            _entry = None
+        if _entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return _entry
+
+    def put(self, key, output, ttl=None, persist=False):
+        """
+        Store the *output* of a cell, for *ttl* seconds if given
+        """
+        _entry = {'output': output, 'stored': time.time(), 'ttl': ttl}
+        self._memory.put(key, _entry)
+        if persist and self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self._path(key), 'w') as _file:
+                json.dump(_entry, _file)
+            self._trim()
+
+    def _trim(self):
+        # Remove the least recently used files beyond maxsize
+        _paths = sorted(glob.glob(os.path.join(self.directory, '*.json')),
+                        key=os.path.getmtime)
+        for _path in _paths[:max(0, len(_paths) - self.maxsize)]:
+            try:
+                os.remove(_path)
+            except OSError:
+                pass
+
+    def persisted(self):
+        """
+        Number of entries on disk
+        """
+        if self.directory is None:
+            return 0
+        return len(glob.glob(os.path.join(self.directory, '*.json')))
+
+    def invalidate(self, key):
+        """
+        Drop the entry for *key* from memory and disk
+        """
+        self._memory.invalidate(key)
+        if self.directory is not None:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Drop all entries from memory and disk
+        """
+        self._memory.clear()
+        if self.directory is not None:
+            for _path in glob.glob(os.path.join(self.directory, '*.json')):
+                try:
+                    os.remove(_path)
+                except OSError:
+                    pass
@@ -4,18 +4,26 @@ Virtuoso kernel for Jupyter.
 Inspired by https://github.com/takluyver/bash_kernel
 """
 from ipykernel.kernelbase import Kernel
-from IPython.display import HTML, Image
 from ipykernel import (
     get_connection_file, get_connection_info, connect_qtconsole
 )
 import signal
-from .shell import VirtuosoShell, VirtuosoExceptions
-from pexpect import EOF
+from .shell import (
+    VirtuosoShell, VirtuosoExceptions, VirtuosoConnectionLost, VirtuosoTimeout
+)
 import colorama
 import re
 import time
 import os
 import zmq
+import base64
+import tempfile
+from jupyter_core.paths import jupyter_data_dir
+from .plots import encode_plot
+from .cache import LRUCache, ResultCache, dependency_state
+from .timing import SessionTimings, breakdown, format_time
+from .profiler import parse_summary, sort_rows, format_text, format_html
+from .lexer import Lexer
 
 __version__ = '0.2'
 
@@ -54,8 +62,8 @@ class VirtuosoKernel(Kernel):
         """
         return self._shell.banner
 
-    _err_header = HTML('<span style="color:red; font-family:monospace">'
-                       'Traceback:</span>')
+    _err_header = ('<span style="color:red; font-family:monospace">'
+                   'Traceback:</span>')
 
     def __init__(self, **kwargs):
         super(VirtuosoKernel, self).__init__(**kwargs)
@@ -68,17 +76,31 @@ class VirtuosoKernel(Kernel):
         self._plt_height = 5.0
         self._plt_resolution = 96
         self._plt_file_name = None
-
-        # Start a new window to handle plots
-        #self._shell.run_raw("__win_id__ = awvCreatePlotWindow()")
+        # Wider hardcopies are downscaled before they are sent
+        self._plt_max_width = 1024
+        # Forward printed output to the front-end while a cell runs
+        self._stream_output = True
+        # Longer outputs are previewed; the full text is kept for '%more'
+        self._output_limit = 20000
+        # execution count -> [full output, next page to show, page size]
+        self._full_outputs = LRUCache(maxsize=32)
+        self._last_truncated = None
+        # Printed output of the running cell, kept while the limit is on
+        self._printed = []
+        self._printed_size = 0
+        # Latency breakdown of cells, optionally sent in execute_reply metadata
+        self._timings = SessionTimings()
+        self._timing_metadata = False
+        # Outputs of '%%cache' cells; those cached with -p outlive the kernel
+        self._result_cache = ResultCache(
+            maxsize=64,
+            directory=os.path.join(jupyter_data_dir(), 'virtuoso_cache'))
 
     def _handle_interrupt(self, signum, frame):
         """
         Interrupt handler for the kernel
         """
         self._shell.interrupt()
-        #self._shell._shell.sendline("]")
-        self._shell.wait_ready()
 
     def _start_virtuoso(self):
         """
@@ -91,6 +113,7 @@ class VirtuosoKernel(Kernel):
         sig = signal.signal(signal.SIGINT, signal.SIG_DFL)
         try:
             self._shell = VirtuosoShell()
+            self._shell.on_connection_state = self._send_connection_state
         finally:
             signal.signal(signal.SIGINT, sig)
             pass
@@ -100,6 +123,15 @@ class VirtuosoKernel(Kernel):
         """
         Execute the *code* block sent by the front-end.
         """
+        # Cells wait for a PyLL server to (re)start; completion and
+        # inspection requests fail at once instead of freezing the kernel
+        self._shell.wait_for_server = True
+        try:
+            return self._execute(code, silent)
+        finally:
+            self._shell.wait_for_server = False
+
+    def _execute(self, code, silent):
         if code.strip() == '':
             return {'status': 'ok', 'execution_count': self.execution_count,
                     'payload': [], 'user_expressions': {}}
@@ -107,13 +139,21 @@ class VirtuosoKernel(Kernel):
         shell = self._shell
         output = None
         interrupted = False
+        # Set when dfII did not answer: nothing more is sent for this cell
+        stalled = False
         exec_error = None
 
         # Check for cell magic and handle magic
         _magic_match = self._cell_magic_re.search(code)
         if(_magic_match is not None):
-            _exec_status, _exec_message = self._handle_magics(
-                _magic_match.group(1), code)
+            try:
+                _exec_status, _exec_message = self._handle_magics(
+                    _magic_match.group(1), code)
+            except (zmq.ZMQError, KeyboardInterrupt):
+                # Magics that run SKILL are interrupted like cells
+                self._handle_interrupt(signal.SIGINT, None)
+                return {'status': 'abort',
+                        'execution_count': self.execution_count}
 
             if _exec_status is True:
                 return {'status': 'ok',
@@ -123,8 +163,8 @@ class VirtuosoKernel(Kernel):
             else:
                 return {'status': 'error',
                         'execution_count': self.execution_count,
-                        'ename': str('CellMagicError'),
-                        'evalue': str(1),
+                        'ename': _exec_message['ename'],
+                        'evalue': _exec_message['evalue'],
                         'traceback': _exec_message['traceback']}
 
         # Handle plots separately to display inline.
@@ -133,10 +173,6 @@ class VirtuosoKernel(Kernel):
         # and display the image inline.
         _plot_match = self._plot_re.search(code)
 
-        # If there is a plot request, clear the plot window first.
-        #if(_plot_match is not None):
-        #    self._shell.run_raw("clearAll()")
-
         if self._exit_re.search(code) is not None:
             execute_content = {'execution_count': self.execution_count,
                                'data': {'text/plain': "Do '<ctrl>D' to exit"},
@@ -145,85 +181,271 @@ class VirtuosoKernel(Kernel):
                                execute_content)
             return {'status': 'abort', 'execution_count': self.execution_count}
 
+        _stream = None
+        if self._stream_output and not silent:
+            _stream = self._stream_printed
+
+        _start_time = time.time()
+        shell.last_timing = None
         try:
-            output = shell.run_cell(code.rstrip())
+            output = shell.run_cell(code.rstrip(), stream=_stream)
         except (zmq.ZMQError, KeyboardInterrupt):
             self._handle_interrupt(signal.SIGINT, None)
             interrupted = True
             output = shell.output
-        except EOF:
-            output = shell.output + '\r\nRestarting Virtuoso'
-            self._start_virtuoso()
+        except (VirtuosoConnectionLost, VirtuosoTimeout) as vexcp:
+            # The shell reconnects on the next request after a lost
+            # connection, and has interrupted dfII after a timeout
+            stalled = True
+            exec_error = vexcp.value
+            output = ''
         except VirtuosoExceptions as vexcp:
             exec_error = vexcp.value
             output = shell.output
+        finally:
+            if _stream is not None:
+                self._end_stream()
+
+        if shell.last_timing is not None:
+            self._timings.add(breakdown(time.time() - _start_time,
+                                        **shell.last_timing))
+
+        # Completions and plots are best-effort: a follow-up request that
+        # fails must not cost the cell its reply
+        if not interrupted and not stalled:
+            # Pick up procedures and globals defined by this cell
+            try:
+                shell.update_completions(code)
+            except VirtuosoExceptions:
+                pass
 
-        #if(_plot_match is not None):
-        #    # Ask the shell to save a hardcopy
-        #    self._plt_file_name = '/tmp/jupyter_virtuoso_%s.png' % \
-        #                          str(time.time())
-        #    _plt_cmd = ('saveGraphImage(?window __win_id__ ?fileName "%s" '
-        #                '?width %f ?height %f ?units "inch" '
-        #                '?resolution %d ?resolutionUnits "pixels/in" '
-        #                '?saveEachSubwindowSeparately nil)') %\
-        #               (self._plt_file_name, self._plt_width, self._plt_height,
-        #                self._plt_resolution)
-        #    self._shell.run_raw(_plt_cmd)
-
-        #    if(os.path.isfile(self._plt_file_name)):
-        #        # Display this image inline
-        #        _image = Image(filename=self._plt_file_name)
-        #        display_content = {'source': "kernel",
-        #                           'data': {'image/png':
-        #                                    _image.data.encode('base64')},
-        #                           'metadata': {}}
-        #        self.send_response(self.iopub_socket, 'display_data',
-        #                           display_content)
-
-        #        # Delete the hardcopy
-        #        os.remove(self._plt_file_name)
+        if(_plot_match is not None and not interrupted and not stalled and
+           not silent):
+            try:
+                self._capture_plot()
+            except VirtuosoExceptions:
+                pass
 
         if interrupted:
             return {'status': 'abort', 'execution_count': self.execution_count}
 
         if (not silent) and (output != ''):
-            execute_content = {'execution_count': self.execution_count,
-                               'data': {'text/plain': output},
-                               'metadata': {}}
-            self.send_response(self.iopub_socket, 'execute_result',
-                               execute_content)
+            self._send_result(self._preview_output(output))
 
         if exec_error is not None:
-            html_content = {'source': 'kernel', 'data': {'text/html':
-                                                         self._err_header.data,
-                                                         'text/plain':
-                                                         (colorama.Fore.RED +
-                                                          'Traceback:' +
-                                                          colorama.Fore.RESET)
-                                                         },
-                            'metadata': {}}
-            self.send_response(self.iopub_socket, 'display_data', html_content)
-
-            # TODO: Need to get a proper traceback like in ultraTB
-            # tb_content = ["", 0, "", exec_error[2]]
-            tb_content = [exec_error[2]]
-            err_content = {'execution_count': self.execution_count,
-                           'ename': str(exec_error[0]),
-                           'evalue': str(exec_error[1]),
-                           'traceback': tb_content}
-            self.send_response(self.iopub_socket, 'error', err_content)
-
+            err_content = self._send_error(exec_error)
             return {'status': 'error',
                     'execution_count': self.execution_count,
-                    'ename': str(exec_error[0]),
-                    'evalue': str(exec_error[1]),
-                    'traceback': tb_content}
+                    'ename': err_content['ename'],
+                    'evalue': err_content['evalue'],
+                    'traceback': err_content['traceback']}
         else:
             return {'status': 'ok',
                     'execution_count': self.execution_count,
                     'payload': [],
                     'user_expressions': {}}
 
+    def _send_result(self, text):
+        """
+        Send *text* as the result of the cell
+        """
+        execute_content = {'execution_count': self.execution_count,
+                           'data': {'text/plain': text},
+                           'metadata': {}}
+        self.send_response(self.iopub_socket, 'execute_result',
+                           execute_content)
+
+    def _send_error(self, exec_error):
+        """
+        Show the error (etype, evalue, tb) of the cell and return the
+        content of the error message
+        """
+        html_content = {'source': 'kernel', 'data': {'text/html':
+                                                     self._err_header,
+                                                     'text/plain':
+                                                     (colorama.Fore.RED +
+                                                      'Traceback:' +
+                                                      colorama.Fore.RESET)
+                                                     },
+                        'metadata': {}}
+        self.send_response(self.iopub_socket, 'display_data', html_content)
+
+        # TODO: Need to get a proper traceback like in ultraTB
+        # tb_content = ["", 0, "", exec_error[2]]
+        tb_content = [exec_error[2]]
+        err_content = {'execution_count': self.execution_count,
+                       'ename': str(exec_error[0]),
+                       'evalue': str(exec_error[1]),
+                       'traceback': tb_content}
+        self.send_response(self.iopub_socket, 'error', err_content)
+        return err_content
+
+    def _capture_plot(self):
+        """
+        Ask Virtuoso for a hardcopy of the current plot window and display
+        it inline
+        """
+        self._plt_file_name = os.path.join(
+            tempfile.gettempdir(), 'jupyter_virtuoso_%s.png' % str(time.time()))
+        _plt_cmd = ('saveGraphImage(?window awvGetCurrentWindow() '
+                    '?fileName "%s" '
+                    '?width %f ?height %f ?units "inch" '
+                    '?resolution %d ?resolutionUnits "pixels/in" '
+                    '?saveEachSubwindowSeparately nil)') %\
+                   (self._plt_file_name, self._plt_width, self._plt_height,
+                    self._plt_resolution)
+        self._shell.run_raw(_plt_cmd)
+
+        if(os.path.isfile(self._plt_file_name)):
+            try:
+                _png_data = encode_plot(self._plt_file_name,
+                                        self._plt_max_width)
+            except (IOError, OSError, ValueError):
+                return  # A broken hardcopy is not shown
+            display_content = {'source': "kernel",
+                               'data': {'image/png': _png_data},
+                               'metadata': {}}
+            self.send_response(self.iopub_socket, 'display_data',
+                               display_content)
+
+    def _preview_output(self, output):
+        """
+        Return the head and tail of an output longer than the output limit.
+
+        The full output is kept so that '%more' can show it page by page.
+        """
+        if not self._output_limit or len(output) <= self._output_limit:
+            return output
+        self._keep_full(output)
+        _half = self._output_limit // 2
+        return ('%s\n%s... [%d characters not shown; %%more %d pages '
+                'through the full output] ...%s\n%s' %
+                (output[:_half], colorama.Fore.YELLOW,
+                 len(output) - 2 * _half, self.execution_count,
+                 colorama.Fore.RESET, output[-_half:]))
+
+    def _keep_full(self, text):
+        """
+        Keep the full text of a truncated output of this cell for '%more'.
+
+        Truncated printed output and result of the same cell are joined.
+        """
+        _entry = None
+        if self._last_truncated == self.execution_count:
+            _entry = self._full_outputs.get(self.execution_count)
+        if _entry is None:
+            self._full_outputs.put(self.execution_count,
+                                   [text, 1, self._output_limit])
+        else:
+            _entry[0] += text
+        self._last_truncated = self.execution_count
+
+    def _page_output(self, count, page):
+        """
+        Return a page of a truncated output for '%more [count [page]]'.
+
+        Without a page, the page after the one shown last is returned.
+        """
+        if count == '':
+            count = self._last_truncated
+        _entry = self._full_outputs.get(int(count)) if count else None
+        if _entry is None:
+            return 'No truncated output to show'
+        _text, _next, _size = _entry
+        _page = int(page) if page != '' else _next
+        _pages = max(1, -(-len(_text) // _size))
+        if not 1 <= _page <= _pages:
+            return 'Out[%s] has %d pages' % (count, _pages)
+        _entry[1] = _page + 1
+        _start = (_page - 1) * _size
+        return ('%s[Out[%s] page %d of %d]%s\n%s' %
+                (colorama.Fore.YELLOW, count, _page, _pages,
+                 colorama.Fore.RESET, _text[_start:_start + _size]))
+
+    def _send_stream(self, text):
+        """
+        Send partial output of the running cell to the front-end
+        """
+        stream_content = {'name': 'stdout', 'text': text}
+        self.send_response(self.iopub_socket, 'stream', stream_content)
+
+    def _stream_printed(self, text):
+        """
+        Send printed output of the running cell within the output limit.
+
+        Up to half the limit is sent as it arrives. The rest is held back
+        until `_end_stream`, which sends it all, or only its tail if the
+        cell printed more than the limit.
+        """
+        if not self._output_limit:
+            self._send_stream(text)
+            return
+        _shown = self._printed_size
+        self._printed.append(text)
+        self._printed_size += len(text)
+        _half = self._output_limit // 2
+        if _shown < _half:
+            self._send_stream(text[:_half - _shown])
+        if _shown <= self._output_limit < self._printed_size:
+            self._send_stream('\n%s... [printed output truncated; its end '
+                              'follows when the cell finishes] ...%s\n' %
+                              (colorama.Fore.YELLOW, colorama.Fore.RESET))
+
+    def _end_stream(self):
+        """
+        Send the printed output held back by `_stream_printed` once the cell
+        has finished, keeping the full text for '%more' if it is truncated
+        """
+        _printed = ''.join(self._printed)
+        self._printed = []
+        self._printed_size = 0
+        if not self._output_limit:
+            return
+        _half = self._output_limit // 2
+        if len(_printed) <= self._output_limit:
+            if len(_printed) > _half:
+                self._send_stream(_printed[_half:])
+            return
+        self._keep_full(_printed)
+        self._send_stream('%s... [%d characters not shown; %%more %d pages '
+                          'through the full output] ...%s\n%s' %
+                          (colorama.Fore.YELLOW, len(_printed) - 2 * _half,
+                           self.execution_count, colorama.Fore.RESET,
+                           _printed[-_half:]))
+
+    def _send_connection_state(self, message):
+        """
+        Tell the front-end that the connection to Virtuoso changed
+        """
+        stream_content = {'name': 'stderr',
+                          'text': '%s[%s]%s\n' % (colorama.Fore.YELLOW,
+                                                 message,
+                                                 colorama.Fore.RESET)}
+        self.send_response(self.iopub_socket, 'stream', stream_content)
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        """
+        Add the cell's latency breakdown to execute_reply if requested
+        """
+        metadata = super(VirtuosoKernel, self).finish_metadata(
+            parent, metadata, reply_content)
+        if self._timing_metadata and self._timings.last is not None:
+            metadata['virtuoso_timing'] = self._timings.last
+        return metadata
+
+    def do_is_complete(self, code):
+        """
+        Tell the front-end whether the code can run or needs more lines
+        """
+        if self._cell_magic_re.search(code) is not None:
+            return {'status': 'complete'}
+        _lexer = Lexer(code)
+        _status = _lexer.is_complete()
+        if _status == 'incomplete':
+            return {'status': _status,
+                    'indent': '    ' * len(_lexer.open_brackets)}
+        return {'status': _status}
+
     def do_complete(self, code, cursor_pos):
         code = code[:cursor_pos]
         default = {'matches': [],
@@ -235,11 +457,11 @@ class VirtuosoKernel(Kernel):
         if not code or code[-1] == ' ':
             return default
 
-        _lines = code.splitlines(True)
-        if not _lines:
+        # The whole cell up to the cursor decides what is being completed
+        try:
+            _matches, _token = self._shell.get_matches(code)
+        except VirtuosoExceptions:
             return default
-
-        _matches, _token = self._shell.get_matches(_lines[-1])
         # when completing methods/attributes, _token is ''
         _cstart = cursor_pos - len(_token)
 
@@ -254,7 +476,7 @@ class VirtuosoKernel(Kernel):
                 'status': 'ok'}
 
     def _html_introspection(self, info, keyword):
-        import re
+        from IPython.display import HTML
         info = re.sub(r'(\?\w+)', r'<i>\1</i>', info, count=0)
         info = re.sub(r'(%s)' % keyword, r'<b>\1</b>', info, count=0)
         return HTML(info)
@@ -277,7 +499,10 @@ class VirtuosoKernel(Kernel):
             return default
 
         _token = _tokens[-1]
-        _info = self._shell.get_info(_token)
+        try:
+            _info = self._shell.get_info(_token)
+        except VirtuosoExceptions:
+            return default
 
         if len(_info) == 0:
             return default
@@ -305,10 +530,31 @@ class VirtuosoKernel(Kernel):
     def _handle_magics(self, magic_code, code):
         """
         Handle cell magics
+
+        SKILL errors of a magic are reported like those of a cell.
+        """
+        try:
+            _content = self._run_magic(magic_code, code)
+        except VirtuosoExceptions as vexcp:
+            return False, self._send_error(vexcp.value)
+        if isinstance(_content, tuple):
+            return _content  # '%image' reports its own outcome
+
+        if(_content is not None):
+            self._send_result(_content)
+            return True, None
+        err_content = {'execution_count': self.execution_count,
+                       'ename': str('CellMagicError'),
+                       'evalue': str(1),
+                       'traceback': ['Invalid cell magic']}
+        self.send_response(self.iopub_socket, 'error', err_content)
+        return False, err_content
+
+    def _run_magic(self, magic_code, code):
+        """
+        Run a magic and return the text to show, or None if it is invalid
         """
-        _exec_status = False
         _content = None
-        err_content = None
         if(magic_code == 'connect_info'):
             try:
                 connection_file = get_connection_file()
@@ -334,31 +580,297 @@ class VirtuosoKernel(Kernel):
         if(magic_code == 'flush'):
             _content = ''
 
-        if(_content is not None):
-            execute_content = {'execution_count': self.execution_count,
-                               'data': {'text/plain': _content},
-                               'metadata': {}}
-            self.send_response(self.iopub_socket, 'execute_result',
-                               execute_content)
-            _exec_status = True
+        if(magic_code == 'parallel'):
+            _content = self._run_parallel(code)
+
+        if(magic_code == 'fetch'):
+            _args = re.search(r'^%(\S+)(?:\s*)(\S+)(?:\s*)(\S*)', code)
+            if _args is not None:
+                _content = self._fetch_array(_args.group(2), _args.group(3))
+
+        if(magic_code == 'more'):
+            _args = re.search(r'^%(\S+)(?:\s*)(\d*)(?:\s*)(\d*)', code)
+            _content = self._page_output(_args.group(2), _args.group(3))
+
+        if(magic_code == 'output_limit'):
+            _args = re.search(r'^%(\S+)(?:\s*)(\d*|off)\s*$', code)
+            if _args is not None:
+                if _args.group(2) == 'off':
+                    self._output_limit = None
+                elif _args.group(2) != '':
+                    self._output_limit = int(_args.group(2)) or None
+                _content = 'Output limit: %s' % (
+                    self._output_limit or 'off')
+
+        if(magic_code == 'timing'):
+            _args = re.search(r'^%(\S+)(?:\s*)(\S*)', code)
+            _content = self._show_timing(_args.group(2))
+
+        if(magic_code == 'timeit'):
+            _content = self._timeit(code)
+
+        if(magic_code == 'prun'):
+            _content = self._prun(code)
+
+        if(magic_code == 'connection'):
+            _content = self._show_connection()
+
+        if(magic_code == 'cache'):
+            _content = self._cache(code)
+
+        if(magic_code == 'timeout'):
+            _args = re.search(r'^%(\S+)(?:\s*)(\S*)', code)
+            _content = self._set_timeout(_args.group(2))
+
+        return _content
+
+    def _run_parallel(self, code):
+        """
+        Run each top-level expression of a '%%parallel' cell on the pool of
+        PyLL servers.
+
+        Without a cell body, list the servers in the pool.
+        """
+        _lines = code.split('\n', 1)
+        _exprs = []
+        if len(_lines) > 1:
+            _exprs = Lexer(_lines[1]).statements()
+        if not _exprs:
+            return '%d PyLL server(s) in the pool' % len(self._shell.pool)
+        _results = self._shell.map(_exprs)
+        _content = '\n'.join('%s%d>%s %s' % (colorama.Fore.YELLOW, _num,
+                                             colorama.Fore.RESET, _output)
+                             for _num, (_output, _error) in
+                             enumerate(_results, 1))
+        _errors = [_error for _output, _error in _results
+                   if _error is not None]
+        if _errors:
+            # All outputs are shown, then the first error
+            self._send_result(_content)
+            raise VirtuosoExceptions(_errors[0])
+        return _content
+
+    def _fetch_array(self, expression, filename):
+        """
+        Fetch a numeric SKILL value as a NumPy array for '%fetch'.
+
+        The array is summarized in the notebook and, if *filename* is given,
+        saved there in NumPy's .npy format.
+        """
+        try:
+            _values = self._shell.fetch_array(expression)
+        except ImportError:
+            raise VirtuosoExceptions(("ImportError", 1, '%fetch needs NumPy'))
+        _content = '%s: %d values\n%r' % (expression, len(_values), _values)
+        if filename != '':
+            import numpy
+            numpy.save(filename, _values)
+            _content += '\nSaved to %s' % filename
+        return _content
+
+    def _show_timing(self, option):
+        """
+        '%timing' shows where the last cell's time went and the session's
+        latency histograms. 'on'/'off' toggle adding the breakdown to the
+        execute_reply metadata and 'reset' clears the histograms.
+        """
+        if option in ('on', 'off'):
+            self._timing_metadata = (option == 'on')
+            return 'Timing metadata: %s' % option
+        if option == 'reset':
+            self._timings = SessionTimings()
+            return 'Timing histograms cleared'
+        if option != '':
+            return None
+        return ('Last cell:\n%s\n\nThis session:\n%s' %
+                (self._timings.format_last(),
+                 self._timings.format_histograms()))
+
+    def _timeit(self, code):
+        """
+        Time SKILL code inside Virtuoso for '%timeit' and '%%timeit'.
+
+        '%timeit [-n N] [-r R] expr' times one expression and '%%timeit'
+        the body of the cell. N loops per run are chosen automatically
+        unless given; R runs default to 7.
+        """
+        _lines = code.split('\n', 1)
+        _args = re.search(r'^%+\S+((?:\s+-[nr]\s*\d+)*)\s*(.*)$', _lines[0])
+        _opts = dict(re.findall(r'-([nr])\s*(\d+)', _args.group(1)))
+        if code.startswith('%%'):
+            _body = _lines[1] if len(_lines) > 1 else ''
         else:
-            err_content = {'execution_count': self.execution_count,
-                           'ename': str('CellMagicError'),
-                           'evalue': str(1),
-                           'traceback': ['Invalid cell magic']}
-            self.send_response(self.iopub_socket, 'error', err_content)
+            _body = _args.group(2)
+        if _body.strip() == '':
+            return None
+        _repeat = int(_opts.get('r', 7))
+        _number, _times = self._shell.timeit(_body, int(_opts.get('n', 0)),
+                                             _repeat)
+        _per_loop = [_time / _number for _time in _times]
+        _mean = sum(_per_loop) / len(_per_loop)
+        _std = (sum((_time - _mean) ** 2 for _time in _per_loop) /
+                len(_per_loop)) ** 0.5
+        return (u'%s \u00b1 %s per loop (mean \u00b1 std. dev. of %d runs, '
+                u'%d loops each), best %s' %
+                (format_time(_mean), format_time(_std), _repeat, _number,
+                 format_time(min(_per_loop))))
+
+    def _prun(self, code):
+        """
+        Profile the body of a '%%prun [-m] [-s column] [-l N]' cell.
 
-        return _exec_status, err_content
+        '-m' profiles memory instead of time, '-s' sorts by the column whose
+        name starts with the given text and '-l' keeps the top N functions.
+        The profile is displayed as a table and the cell's output returned.
+        A cell that fails shows its profile and output, then its error.
+        """
+        _lines = code.split('\n', 1)
+        _args = _lines[0].split()[1:]
+        _opts = {}
+        while _args:
+            _opt = _args.pop(0)
+            if _opt == '-m':
+                _opts['m'] = True
+            elif _opt in ('-s', '-l') and _args:
+                _opts[_opt[1]] = _args.pop(0)
+            else:
+                return None
+        if 'l' in _opts and not _opts['l'].isdigit():
+            return None
+        if len(_lines) < 2 or _lines[1].strip() == '':
+            return None
+        _summary, _exec_error = self._shell.profile(
+            _lines[1].rstrip(), 'memory' if 'm' in _opts else 'time')
+        _columns, _rows = parse_summary(_summary)
+        try:
+            if 's' in _opts:
+                _rows = sort_rows(_columns, _rows, _opts['s'])
+        except ValueError as verr:
+            raise VirtuosoExceptions(("ValueError", 1, str(verr)))
+        if 'l' in _opts:
+            _rows = _rows[:int(_opts['l'])]
+        display_content = {'source': 'kernel',
+                           'data': {'text/html': format_html(_columns, _rows),
+                                    'text/plain': format_text(_columns,
+                                                              _rows)},
+                           'metadata': {}}
+        self.send_response(self.iopub_socket, 'display_data', display_content)
+        if _exec_error is not None:
+            # The profile is kept, then the cell fails as usual
+            self._send_result(self._preview_output(self._shell.output))
+            raise VirtuosoExceptions(_exec_error)
+        return self._shell.output
+
+    def _show_connection(self):
+        """
+        Describe the connection to the PyLL server for '%connection'
+        """
+        _lines = ['State: %s' % self._shell.connection_state]
+        _heartbeat = self._shell.heartbeat()
+        if _heartbeat is not None:
+            _endpoint, _round_trip, _answer = _heartbeat
+            _lines.append('Server: %s' % _endpoint)
+            if _answer is None:
+                _lines.append('Heartbeat: no answer')
+            elif 'pid' in _answer:
+                _lines.append('Heartbeat: %s (pid %s, dfII %s)' %
+                              (format_time(_round_trip), _answer['pid'],
+                               'busy' if _answer['busy'] else 'idle'))
+        return '\n'.join(_lines)
+
+    def _cache(self, code):
+        """
+        Memoize the output of a '%%cache [-t SECONDS] [-d PATTERN]... [-p]'
+        cell.
+
+        The output is replayed while the cell's code and the modification
+        times of the files matching the '-d' glob patterns are unchanged,
+        for at most '-t' seconds if given; '-p' also keeps it on disk for
+        later kernels. Side effects of the cell in Virtuoso are not
+        replayed. '%cache clear' drops all entries and '%cache' counts them.
+        """
+        _lines = code.split('\n', 1)
+        _args = _lines[0].split()[1:]
+        if not code.startswith('%%'):
+            if _args == ['clear']:
+                self._result_cache.clear()
+                return 'Cache cleared'
+            if _args:
+                return None
+            return ('%d cached cell(s) in memory, %d on disk; %d hit(s), '
+                    '%d miss(es)' % (len(self._result_cache),
+                                     self._result_cache.persisted(),
+                                     self._result_cache.hits,
+                                     self._result_cache.misses))
+        _ttl = None
+        _dependencies = []
+        _persist = False
+        while _args:
+            _opt = _args.pop(0)
+            if _opt == '-p':
+                _persist = True
+            elif _opt == '-d' and _args:
+                _dependencies.append(_args.pop(0))
+            elif _opt == '-t' and _args:
+                try:
+                    _ttl = float(_args.pop(0))
+                except ValueError:
+                    return None
+            else:
+                return None
+        if len(_lines) < 2 or _lines[1].strip() == '':
+            return None
+        _body = _lines[1].rstrip()
+        _key = ResultCache.key(_body, dependency_state(_dependencies))
+        _entry = self._result_cache.get(_key)
+        if _entry is None:
+            try:
+                # Not streamed, so that printed output is cached too
+                _output = self._shell.run_cell(_body)
+            except VirtuosoExceptions:
+                # Failed cells are not cached; show their output as usual
+                if self._shell.output != '':
+                    self._send_result(self._preview_output(self._shell.output))
+                raise
+            self._result_cache.put(_key, _output, _ttl, _persist)
+            return self._preview_output(_output)
+        self._send_stream('%s[cached %s]%s\n' % (
+            colorama.Fore.YELLOW,
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(_entry['stored'])),
+            colorama.Fore.RESET))
+        return self._preview_output(_entry['output'])
+
+    def _set_timeout(self, value):
+        """
+        Set the per-cell timeout from the '%timeout' magic's argument.
+
+        Returns the message to display or None for invalid arguments.
+        """
+        if value in ('off', 'none'):
+            self._shell.timeout = None
+        elif value != '':
+            try:
+                self._shell.timeout = float(value)
+            except ValueError:
+                return None
+            if self._shell.timeout <= 0:
+                self._shell.timeout = None
+        if self._shell.timeout is None:
+            return 'Cell timeout: off'
+        return 'Cell timeout: %g s' % self._shell.timeout
 
     def _show_image_inline(self, filename):
         _exec_status = False
         err_content = None
         if(os.path.isfile(filename)):
             # Display this image inline
+            from IPython.display import Image
             _image = Image(filename=filename)
             display_content = {'source': "kernel",
                                'data': {'image/png':
-                                        _image.data.encode('base64')},
+                                        base64.b64encode(_image.data).decode(
+                                            'ascii')},
                                'metadata': {}}
             self.send_response(self.iopub_socket, 'display_data',
                                display_content)
@@ -0,0 +1,355 @@
+"""
+Tokenizer for SKILL code, so that cells can be checked in the kernel.
+
+It knows enough SKILL to tell where strings, comments and brackets begin
+and end, in both C-style `f(x)` and Lisp-style `(f x)` calls, including the
+super right bracket `]` that closes all open parentheses.
+"""
+import re
+from collections import namedtuple
+
+# kind: one of the group names of _token_re; start: offset in the text;
+# depth: number of brackets open before the token
+Token = namedtuple('Token', ['kind', 'text', 'start', 'depth'])
+
+_token_re = re.compile(r'''
+    (?P<space>(?:[ \t\r\n\f]|\\\n)+)
+  | (?P<comment>;[^\n]*|/\*[\s\S]*?(?:\*/|\Z))
+  | (?P<string>"(?:[^"\\]|\\[\s\S])*(?:"|\\?\Z))
+  | (?P<keyword>\?[A-Za-z_]\w*)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<name>[A-Za-z_][\w]*)
+  | (?P<open>[({\[])
+  | (?P<close>[)}\]])
+  | (?P<operator>->|~>|==|!=|<=|>=|&&|\|\||\+\+|--|[-+*/<>=!&|:@,.`'~^%])
+  | (?P<other>[\s\S])
+''', re.VERBOSE)
+
+# A string token that ends with its closing quote
+_closed_string_re = re.compile(r'"(?:[^"\\]|\\[\s\S])*"\Z')
+
+_closers = {'(': ')', '{': '}', '[': ']'}
+
+# Characters past its end that a token's pattern may look at: '1.5e-' is a
+# number followed by 'e' and '-' until a digit comes
+_lookahead = 2
+
+# Forms that bind names: procedure definitions, variable lists and loops
+_def_forms = ('procedure', 'nprocedure', 'mprocedure', 'defun', 'defmacro',
+              'globalProc', 'defglobalfun')
+_bind_forms = ('let', 'letseq', 'letrec', 'prog', 'lambda', 'nlambda')
+_loop_forms = ('foreach', 'for', 'forall', 'exists', 'setof')
+# Optional first argument of foreach & co.
+_mappers = ('mapc', 'mapcar', 'maplist', 'mapcan', 'mapcon')
+# Forms that assign their first argument
+_assign_forms = ('setq', 'defvar')
+
+
+class Lexer(object):
+    """
+    Incremental tokenizer: text can be fed in pieces, and text that extends
+    what was fed before only costs the new part.
+    """
+    def __init__(self, text=''):
+        super(Lexer, self).__init__()
+        self.text = ''
+        self.tokens = []
+        # Indices of the open brackets that are not closed yet
+        self._stack = []
+        # Index of a closing bracket -> indices of the brackets it closed
+        self._closed = {}
+        # Indices of closing brackets that do not match
+        self._bad = []
+        self.feed(text)
+
+    @classmethod
+    def extend(cls, lexer, text):
+        """
+        Return a lexer for *text*, reusing *lexer* if *text* continues the
+        text it has seen
+        """
+        if lexer is not None and text.startswith(lexer.text):
+            lexer.feed(text[len(lexer.text):])
+            return lexer
+        return cls(text)
+
+    def feed(self, text):
+        """
+        Tokenize more text
+        """
+        if not text:
+            return
+        # Tokens that end near the old end may continue in the new text,
+        # e.g. '1e' + '5' or '1.5e-' + '3'
+        _pos = len(self.text)
+        while self.tokens and self.tokens[-1].start + \
+                len(self.tokens[-1].text) >= len(self.text) - _lookahead:
+            _pos = self._pop().start
+        self.text += text
+        while _pos < len(self.text):
+            _match = _token_re.match(self.text, _pos)
+            self._push(Token(_match.lastgroup, _match.group(), _pos,
+                             len(self._stack)))
+            _pos = _match.end()
+
+    def _push(self, token):
+        _index = len(self.tokens)
+        self.tokens.append(token)
+        if token.kind == 'open':
+            self._stack.append(_index)
+        elif token.kind == 'close':
+            _open = self._stack and self.tokens[self._stack[-1]].text
+            if _open and _closers[_open] == token.text:
+                self._closed[_index] = [self._stack.pop()]
+            elif _open == '(' and token.text == ']':
+                # SKILL's super right bracket closes all open parentheses
+                _parens = []
+                while self._stack and \
+                        self.tokens[self._stack[-1]].text == '(':
+                    _parens.insert(0, self._stack.pop())
+                self._closed[_index] = _parens
+            else:
+                self._bad.append(_index)
+
+    def _pop(self):
+        _index = len(self.tokens) - 1
+        _token = self.tokens.pop()
+        if _token.kind == 'open':
+            self._stack.pop()
+        elif _index in self._closed:
+            self._stack.extend(self._closed.pop(_index))
+        elif _token.kind == 'close':
+            self._bad.remove(_index)
+        return _token
+
+    @property
+    def open_brackets(self):
+        """
+        Brackets that are still open at the end of the text, outermost first
+        """
+        return [self.tokens[_index] for _index in self._stack]
+
+    def state(self):
+        """
+        Where the text ends: in 'code', a 'string' or a 'comment'
+        """
+        if not self.tokens:
+            return 'code'
+        _last = self.tokens[-1]
+        if _last.kind == 'string' and \
+                _closed_string_re.match(_last.text) is None:
+            return 'string'
+        if _last.kind == 'comment':
+            if _last.text.startswith(';'):
+                return 'comment'
+            if len(_last.text) < 4 or not _last.text.endswith('*/'):
+                return 'comment'
+        return 'code'
+
+    def error(self):
+        """
+        Describe why the text cannot be evaluated as it is, or return None
+        """
+        if self._bad:
+            _token = self.tokens[self._bad[0]]
+            return "Unmatched '%s' at %s" % (_token.text,
+                                             self.position(_token.start))
+        _state = self.state()
+        if _state == 'string':
+            return 'Unterminated string starting at %s' % \
+                self.position(self.tokens[-1].start)
+        if _state == 'comment' and self.tokens[-1].text.startswith('/*'):
+            return 'Unterminated comment starting at %s' % \
+                self.position(self.tokens[-1].start)
+        if self._stack:
+            _token = self.tokens[self._stack[-1]]
+            return "'%s' at %s is not closed" % (_token.text,
+                                                 self.position(_token.start))
+        return None
+
+    def is_complete(self):
+        """
+        'complete', 'incomplete' if more text could complete it, or
+        'invalid', as for Jupyter's is_complete_request
+        """
+        if self._bad:
+            return 'invalid'
+        if self._stack or self.state() == 'string' or \
+                self.text.endswith('\\\n') or self.text.endswith('\\'):
+            return 'incomplete'
+        if self.state() == 'comment' and self.tokens[-1].text.startswith('/*'):
+            return 'incomplete'
+        return 'complete'
+
+    def is_multiline(self):
+        """
+        True if the text holds several top-level lines of code
+        """
+        return len(self.statements()) > 1
+
+    def statements(self):
+        """
+        Texts of the top-level expressions, which are separated by line
+        breaks outside brackets. Comments around them are left out.
+        """
+        _statements = []
+        _first = _last = None
+        _newline = False
+        for _token in self.tokens:
+            if _token.kind == 'comment':
+                continue
+            if _token.kind == 'space':
+                _newline = _newline or (
+                    _first is not None and _token.depth == 0 and
+                    '\n' in _token.text.replace('\\\n', ''))
+                continue
+            if _newline:
+                _statements.append(self.text[_first.start:_last.start +
+                                             len(_last.text)])
+                _first = None
+                _newline = False
+            if _first is None:
+                _first = _token
+            _last = _token
+        if _first is not None:
+            _statements.append(self.text[_first.start:_last.start +
+                                         len(_last.text)])
+        return _statements
+
+    def code_tokens(self):
+        """
+        Tokens other than spaces and comments
+        """
+        return [_token for _token in self.tokens
+                if _token.kind not in ('space', 'comment')]
+
+    def call_name(self):
+        """
+        Name of the function whose argument list the text ends in, whether
+        called as `f(...` or `(f ...`, or None
+        """
+        _parens = [_index for _index in self._stack
+                   if self.tokens[_index].text == '(']
+        if not _parens:
+            return None
+        _before = [_token for _token in self.tokens[:_parens[-1]]
+                   if _token.kind not in ('space', 'comment')]
+        if _before and _before[-1].kind == 'name':
+            return _before[-1].text
+        _after = [_token for _token in self.tokens[_parens[-1] + 1:]
+                  if _token.kind not in ('space', 'comment')]
+        if _after and _after[0].kind == 'name' and len(_after) > 1:
+            return _after[0].text
+        return None
+
+    def definitions(self):
+        """
+        Names bound by the code and keyword arguments of its procedures.
+
+        Returns the set of procedure names, their arguments, let, prog and
+        lambda variables and loop variables, and a dict of the '?key'
+        arguments of each procedure defined with @key.
+        """
+        _code = self.code_tokens()
+        _names = set()
+        _keywords = {}
+        for _index, _token in enumerate(_code):
+            if _token.kind != 'name':
+                continue
+            # Lisp-style forms follow their own '(', C-style calls precede it
+            _start = _index + 1
+            if _index == 0 or _code[_index - 1].text != '(':
+                if _code[_index + 1:_index + 2] == [] or \
+                        _code[_index + 1].text != '(':
+                    continue
+                _start += 1
+            _rest = _code[_start:]
+            if _token.text in _def_forms:
+                if len(_rest) > 1 and _rest[0].kind == 'name' and \
+                        _rest[1].text == '(':
+                    # procedure(name(args) ...)
+                    _name, _args = _rest[0].text, _rest[1:]
+                elif len(_rest) > 1 and _rest[0].text == '(' and \
+                        _rest[1].kind == 'name':
+                    # (procedure (name args) ...)
+                    _name, _args = _rest[1].text, [_rest[0]] + _rest[2:]
+                else:
+                    continue
+                _names.add(_name)
+                _bound, _keys = self._arguments(_args)
+                _names.update(_bound)
+                if _keys:
+                    _keywords[_name] = ['?' + _key for _key in _keys]
+            elif _token.text in _bind_forms:
+                if _rest and _rest[0].text == '(':
+                    _names.update(self._arguments(_rest)[0])
+            elif _token.text in _loop_forms:
+                if _rest and _rest[0].text in _mappers:
+                    _rest = _rest[1:]
+                if _rest and _rest[0].kind == 'name':
+                    _names.add(_rest[0].text)
+        return _names, _keywords
+
+    def assignments(self):
+        """
+        Names assigned by the code with '=', setq or defvar
+        """
+        _code = self.code_tokens()
+        _names = set()
+        for _index, _token in enumerate(_code):
+            if _token.kind != 'name':
+                continue
+            _next = _code[_index + 1:_index + 3]
+            if _next and _next[0].text == '=':
+                _names.add(_token.text)
+            elif _token.text not in _assign_forms:
+                continue
+            elif _index > 0 and _code[_index - 1].text == '(':
+                # (setq name value)
+                if _next and _next[0].kind == 'name':
+                    _names.add(_next[0].text)
+            elif len(_next) > 1 and _next[0].text == '(' and \
+                    _next[1].kind == 'name':
+                # setq(name value)
+                _names.add(_next[1].text)
+        return _names
+
+    @staticmethod
+    def _arguments(tokens):
+        # Names in the argument list that opens with tokens[0], including
+        # the first name of '(name default)' lists, and those after @key
+        _names = []
+        _keys = []
+        _key = False
+        _depth = 0
+        for _index, _token in enumerate(tokens):
+            if _token.kind == 'open':
+                _depth += 1
+            elif _token.kind == 'close':
+                _depth -= 1
+                if _depth == 0:
+                    break
+            elif _token.kind == 'name':
+                _previous = tokens[_index - 1]
+                if _previous.text == '@':
+                    _key = (_token.text == 'key')
+                elif _depth == 1 or (_depth == 2 and _previous.text == '('):
+                    _names.append(_token.text)
+                    if _key:
+                        _keys.append(_token.text)
+        return _names, _keys
+
+    def position(self, offset):
+        """
+        'line L, column C' of an offset in the text, both counted from 1
+        """
+        _line = self.text.count('\n', 0, offset) + 1
+        _column = offset - (self.text.rfind('\n', 0, offset) + 1) + 1
+        return 'line %d, column %d' % (_line, _column)
+
+
+def tokenize(text):
+    """
+    Return the tokens of *text*
+    """
+    return Lexer(text).tokens
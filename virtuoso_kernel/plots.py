@@ -0,0 +1,36 @@
+"""
+Encoding of plot hardcopies for inline display.
+"""
+import base64
+import io
+import os
+
+
+def encode_plot(filename, max_width=None):
+    """
+    Return the PNG hardcopy in *filename* base64-encoded, and delete the file.
+
+    Images wider than *max_width* pixels are downscaled if PIL is available.
+    """
+    try:
+        with open(filename, 'rb') as _png:
+            _data = _png.read()
+    finally:
+        os.remove(filename)
+    return base64.b64encode(_downscale(_data, max_width)).decode('ascii')
+
+
+def _downscale(data, max_width):
+    if max_width is None:
+        return data
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    _image = Image.open(io.BytesIO(data))
+    if _image.size[0] <= max_width:
+        return data
+    _height = int(_image.size[1] * max_width / float(_image.size[0]))
+    _buffer = io.BytesIO()
+    _image.resize((max_width, _height)).save(_buffer, format='PNG')
+    return _buffer.getvalue()
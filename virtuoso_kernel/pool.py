@@ -0,0 +1,182 @@
+"""
+Pool of PyLL servers for running independent SKILL work in parallel.
+
+Every PyLL server registers itself with a 'virtuoso-pyll-<host>-<pid>.json'
+file in Jupyter's runtime directory.
+"""
+import glob
+import json
+import os
+import time
+from collections import deque
+from socket import gethostname
+
+import zmq
+from jupyter_core.paths import jupyter_data_dir
+
+from .shell import (
+    VirtuosoShellClient, VirtuosoExceptions, VirtuosoTimeout,
+    VirtuosoConnectionLost
+)
+
+
+def find_servers():
+    """
+    Return the connection files of all live PyLL servers
+    """
+    _conn_files = []
+    for _conn_file in sorted(glob.glob(os.path.join(
+            jupyter_data_dir(), "runtime", "virtuoso-pyll-*.json"))):
+        try:
+            with open(_conn_file, "r") as COF:
+                _conn = json.load(COF)
+        except (IOError, ValueError):
+            continue
+        if _conn.get('hostname') == gethostname():
+            # Skip entries left behind by servers that died
+            try:
+                os.kill(_conn['pid'], 0)
+            except OSError:
+                continue
+        _conn_files.append(_conn_file)
+    return _conn_files
+
+
+class VirtuosoPool(object):
+    """
+    Connections to several PyLL servers that share out work.
+
+    Without *conn_files*, the servers are looked up again before each
+    `map`, so servers that start later join the pool and dead ones leave.
+    """
+    def __init__(self, conn_files=None):
+        super(VirtuosoPool, self).__init__()
+        self._discover = conn_files is None
+        # connection file -> client
+        self._clients = {}
+        self._add(conn_files if conn_files is not None else find_servers())
+
+    @property
+    def clients(self):
+        return [self._clients[_conn_file]
+                for _conn_file in sorted(self._clients)]
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _add(self, conn_files):
+        for _conn_file in conn_files:
+            if _conn_file in self._clients:
+                continue
+            try:
+                self._clients[_conn_file] = VirtuosoShellClient(
+                    conn_file=_conn_file)
+            except (IOError, ValueError, zmq.ZMQError, VirtuosoExceptions):
+                pass  # Not answering; tried again at the next refresh
+
+    def _remove(self, client):
+        client.close()
+        self._clients = dict((_conn_file, _client) for _conn_file, _client in
+                             self._clients.items() if _client is not client)
+
+    def refresh(self):
+        """
+        Connect to new servers and drop those that have gone away or do not
+        answer their heartbeat
+        """
+        if not self._discover:
+            return
+        _live = find_servers()
+        for _conn_file, _client in list(self._clients.items()):
+            if _conn_file not in _live or _client.lost or \
+                    _client.ping() is None:
+                self._remove(_client)
+        self._add(_live)
+
+    def map(self, expressions, timeout=None):
+        """
+        Evaluate each expression on whichever server is free.
+
+        Returns the parsed reply payloads in the order of *expressions*.
+        *timeout* limits the time spent waiting for any single reply. A
+        server that stops answering heartbeats is dropped from the pool and
+        its expression gets an error payload.
+        """
+        self.refresh()
+        if not self._clients:
+            raise VirtuosoExceptions(("PoolError", 0,
+                                      "No PyLL servers found"))
+        _todo = deque(enumerate(expressions))
+        _results = [None] * len(_todo)
+        _idle = self.clients
+        _busy = {}
+        # Heartbeats in a row each busy server has missed
+        _misses = {}
+        _poller = zmq.Poller()
+        _interval = VirtuosoShellClient.heartbeat_interval
+        _last_event = time.time()
+        try:
+            while _todo or _busy:
+                if _todo and not _idle and not _busy:
+                    raise VirtuosoConnectionLost((
+                        "ConnectionError", 0,
+                        "No PyLL server of the pool is answering"))
+                while _todo and _idle:
+                    _client = _idle.pop()
+                    _index, _expr = _todo.popleft()
+                    _client.write(_expr)
+                    _busy[_client.socket] = (_client, _index)
+                    _misses[_client] = 0
+                    _poller.register(_client.socket, zmq.POLLIN)
+                _wait = _interval
+                if timeout is not None:
+                    _wait = min(_wait, max(0, _last_event + timeout -
+                                           time.time()))
+                _events = _poller.poll(int(_wait * 1000))
+                if not _events and timeout is not None and \
+                        time.time() >= _last_event + timeout:
+                    # Give up on the stuck servers so they can be used later
+                    for _client, _index in _busy.values():
+                        _client.interrupt()
+                        _client.reset()
+                    raise VirtuosoTimeout((
+                        "TimeoutError", timeout,
+                        "No reply from the pool within %g s" % timeout))
+                if not _events:
+                    for _socket, (_client, _index) in list(_busy.items()):
+                        if _client.ping() is not None:
+                            _misses[_client] = 0
+                            continue
+                        _misses[_client] += 1
+                        if _misses[_client] < _client.heartbeat_misses:
+                            continue
+                        _poller.unregister(_socket)
+                        del _busy[_socket]
+                        _results[_index] = {
+                            'error': '*Error* The PyLL server at %s stopped '
+                                     'answering' % _client.endpoint,
+                            'warning': None, 'info': None, 'result': None}
+                        _client.lost = True
+                        self._remove(_client)
+                    continue
+                _last_event = time.time()
+                for _socket, _event in _events:
+                    _client, _index = _busy.pop(_socket)
+                    _poller.unregister(_socket)
+                    _results[_index] = _client.read_parsed()
+                    _idle.append(_client)
+        except KeyboardInterrupt:
+            # Abort the running expressions so the servers are free again
+            for _client, _index in _busy.values():
+                _client.interrupt()
+                _client.reset()
+            raise
+        return _results
+
+    def close(self):
+        """
+        Close all connections
+        """
+        for _client in self.clients:
+            _client.close()
+        self._clients = {}
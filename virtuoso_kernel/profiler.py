@@ -0,0 +1,96 @@
+"""
+Tables of SKILL profiler summaries for '%%prun'.
+"""
+import re
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+# A summary row: a function name followed by numbers, some maybe percentages
+_row_re = re.compile(r'^\s*(\S+)'
+                     r'((?:\s+[-+]?\d[\d.]*(?:[eE][-+]?\d+)?%?)+)\s*$')
+
+# Sorts the table's rows by the clicked column, toggling the direction
+_sort_js = ("var b=this.closest('table').tBodies[0],i=this.cellIndex,"
+            "d=this.dataset.desc=this.dataset.desc?'':'1';"
+            "Array.prototype.slice.call(b.rows).sort(function(x,y){"
+            "var p=x.cells[i].dataset.v,q=y.cells[i].dataset.v;"
+            "return (isNaN(p)?p.localeCompare(q):p-q)*(d?-1:1)})"
+            ".forEach(function(r){b.appendChild(r)})")
+
+
+def _number(text):
+    return float(text) if re.search(r'[.eE]', text) else int(text)
+
+
+def parse_summary(text):
+    """
+    Split the text written by profileSummary into column names and rows.
+
+    The column names are taken from the header line that mentions the
+    calls, whatever the profiling mode. Each row is a function name
+    followed by its numbers.
+    """
+    _header = None
+    _rows = []
+    for _line in text.splitlines():
+        _match = _row_re.match(_line)
+        if _match is not None:
+            _rows.append([_match.group(1)] +
+                         [_number(_value.rstrip('%'))
+                          for _value in _match.group(2).split()])
+        elif _header is None and re.search(r'\bcalls?\b', _line, re.I):
+            _header = re.split(r'\s{2,}', _line.strip())
+    _width = max([len(_row) for _row in _rows] or [1])
+    if _header is None or len(_header) != _width:
+        _header = ['Function'] + ['Column %d' % _num
+                                  for _num in range(1, _width)]
+    return _header, _rows
+
+
+def sort_rows(columns, rows, key):
+    """
+    Sort rows in descending order of the first column starting with *key*
+    """
+    for _index, _name in enumerate(columns):
+        if _name.lower().startswith(key.lower()):
+            return sorted(rows, key=lambda _row: _row[_index],
+                          reverse=_index > 0)
+    raise ValueError("No column '%s' in %s" % (key, ', '.join(columns)))
+
+
+def format_text(columns, rows):
+    """
+    Plain text table with the function names left aligned
+    """
+    _widths = [max([len(str(_row[_index])) for _row in rows] +
+                   [len(_name)])
+               for _index, _name in enumerate(columns)]
+    _lines = []
+    for _row in [columns] + rows:
+        _lines.append('  '.join(
+            str(_value).ljust(_width) if _index == 0 else
+            str(_value).rjust(_width)
+            for _index, (_value, _width) in enumerate(zip(_row, _widths))))
+    return '\n'.join(_lines)
+
+
+def format_html(columns, rows):
+    """
+    HTML table whose rows can be sorted by clicking on a column header
+    """
+    _html = ['<table><thead><tr>']
+    for _name in columns:
+        _html.append('<th onclick="%s" style="cursor: pointer">%s</th>' %
+                     (_sort_js, escape(_name)))
+    _html.append('</tr></thead><tbody>')
+    for _row in rows:
+        _html.append('<tr>')
+        for _value in _row:
+            _html.append('<td data-v="%s">%s</td>' %
+                         (escape(str(_value), True), escape(str(_value))))
+        _html.append('</tr>')
+    _html.append('</tbody></table>')
+    return ''.join(_html)
@@ -7,6 +7,16 @@ import json
 import re
 import sys
 import os
+import io
+import signal
+import tempfile
+import atexit
+import time
+import shutil
+import zlib
+from array import array
+from collections import deque
+from socket import gethostname
 
 ################################################################################
 # This python server should be started from virtuoso (dfII) via IPC
@@ -24,68 +34,597 @@ import os
 # send anything on STDERR
 
 # Protocol between server and virtuoso:
-#    - Send commands to virtuoso as a string
+#    - Send commands to virtuoso as a string, preceded by a "PYLL_LEN <bytes>"
+#      header line: virtuoso may receive a long command in several pieces
+#      and collects them until the whole command has arrived
 #    - virtuoso evaluates the string
 #    - virtuoso returns JSON payload
 #       - There are four fields: "error", "warning", "info" and "result"
-#    - Stream is terminated with a "PYLL_EOS" string on a newline
+#    - Stream is terminated with a "PYLL_EOS" string on a newline, or, when
+#      __pyll_framing__ is 'length (the default), the payload is preceded by a
+#      "PYLL_LEN <bytes>" header line instead
+#
+# Streaming requests:
+#    - The client sends "<PYLL_STREAM|code|PYLL_STREAM>"
+#    - virtuoso is sent "<PYLL_STREAM|path|PYLL_STREAM>code" and prints to the
+#      file at 'path' while evaluating
+#    - Every reply to the client is a multi-part message [kind, ...]:
+#       - [b"chunk", text] carries new output; the client must answer with
+#         "<PYLL_MORE||PYLL_MORE>" to receive the next message
+#       - [b"reply", meta, payload] carries the final JSON payload
+#
+# Replies:
+#    - Final replies ([b"reply", ...] and [b"shm", ...]) carry a JSON 'meta'
+#      frame after the kind, possibly empty. Its "timing" object holds the
+#      seconds a request spent queued ("queue"), waiting for virtuoso
+#      ("virtuoso") and in the server overall ("server").
+#
+# Interrupts:
+#    - The server also binds a PULL socket on "control_port". Sending
+#      "<PYLL_INTERRUPT|session|PYLL_INTERRUPT>" to it while a request of that
+#      client session is running signals virtuoso to abort the evaluation
+#
+# Numeric transfers:
+#    - "<PYLL_FETCH|expr|PYLL_FETCH>" makes virtuoso reply with a JSON header,
+#      "\nPYLL_DATA\n" and the values of 'expr' as text. The client receives
+#      [b"reply", header, values] with the values packed as little-endian
+#      doubles.
+#
+# Large results:
+#    - Replies larger than PYLL_SHM_THRESHOLD bytes are written by virtuoso to
+#      a file in SHM_DIR and announced with a "PYLL_SHM <bytes> <path>" header
+#      line instead of "PYLL_LEN <bytes>"
+#    - Clients on this host get [b"shm", meta, path, size], map the file and delete
+#      it; other clients receive the contents as a normal reply
+#    - The server deletes the file if the client has not done so by its next
+#      request or the next reply to its session, which means the client gave
+#      up on the request (e.g. after a reset)
+#
+# Clients:
+#    - The server's ROUTER socket accepts any number of REQ clients. Each
+#      client's ZMQ identity is its session ID.
+#    - Requests are queued per session and handed to virtuoso one at a time,
+#      taking turns between sessions, and each reply is routed back to the
+#      client that asked
+#    - A client introduces itself with "<PYLL_HELLO|json|PYLL_HELLO>" and
+#      receives a JSON object describing the server's capabilities, including
+#      virtuoso's version "banner", which is also in the connection file
+#
+# Transports:
+#    - The server listens on TCP ("port", "control_port") and on Unix
+#      sockets ("ipc", "control_ipc"), as PYLL_TRANSPORT selects; unused
+#      transports are null in the connection file. Clients on this host
+#      prefer the Unix sockets.
+#
+# Compression:
+#    - The connection file lists the "compression" methods the server
+#      supports, in order of preference. A client that wants compressed
+#      replies lists the methods it can decode in its hello, and the reply
+#      names the one chosen, if any.
+#    - Reply payloads over PYLL_COMPRESS_THRESHOLD bytes are then compressed
+#      and the method is named by "encoding" in the reply's meta frame
+#
+# Heartbeats:
+#    - The server binds a REP socket on "heartbeat_port" ("heartbeat_ipc").
+#      Any message sent to it is answered at once, even while virtuoso is
+#      busy, with a JSON object holding the server's "pid" and whether
+#      virtuoso is "busy", so clients can tell a long evaluation from a dead
+#      server
+#    - A server that exits removes the connection file if it still names it
+
+# Transports to listen on: "tcp" for clients on any host, "ipc" (Unix
+# sockets) for clients on this host, or "both"
+TRANSPORT = os.environ.get("PYLL_TRANSPORT", "both")
+if not zmq.has("ipc"):
+    TRANSPORT = "tcp"
+IPC_DIR = None
+if TRANSPORT != "tcp":
+    # A short private path: Unix socket paths are limited to ~100 bytes
+    IPC_DIR = tempfile.mkdtemp(prefix="pyll-ipc-")
+    atexit.register(shutil.rmtree, IPC_DIR, True)
 
 context = zmq.Context()
-socket = context.socket(zmq.REP)
-port = socket.bind_to_random_port("tcp://*", min_port=30000, max_port=40000, max_tries=100)
+socket = context.socket(zmq.ROUTER)
+# A client that reconnects after a reset takes over its old session
+socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+control = context.socket(zmq.PULL)
+heartbeat = context.socket(zmq.REP)
+port = control_port = heartbeat_port = None
+ipc = control_ipc = heartbeat_ipc = None
+if TRANSPORT != "ipc":
+    port = socket.bind_to_random_port("tcp://*", min_port=30000, max_port=40000, max_tries=100)
+    control_port = control.bind_to_random_port("tcp://*", min_port=30000, max_port=40000, max_tries=100)
+    heartbeat_port = heartbeat.bind_to_random_port("tcp://*", min_port=30000, max_port=40000, max_tries=100)
+if IPC_DIR is not None:
+    ipc = "ipc://" + os.path.join(IPC_DIR, "request")
+    control_ipc = "ipc://" + os.path.join(IPC_DIR, "control")
+    heartbeat_ipc = "ipc://" + os.path.join(IPC_DIR, "heartbeat")
+    socket.bind(ipc)
+    control.bind(control_ipc)
+    heartbeat.bind(heartbeat_ipc)
 #sys.stdout.write("Server listening on port %d" % port)
 #sys.stdout.flush()
 
-# Connection information for Jupyter client
+# Connection information for Jupyter client.
+# CONN_FILE points at the most recently started server; every server is also
+# listed in its own REGISTRY_FILE so that clients can find all of them.
 CONN_FILE = jupyter_data_dir() + "/runtime/" + "virtuoso-pyll.json"
-with open(CONN_FILE, "w") as COF:
-    json.dump(['localhost', port], COF)
+REGISTRY_FILE = jupyter_data_dir() + "/runtime/" + \
+    "virtuoso-pyll-%s-%d.json" % (gethostname(), os.getpid())
+# Compression methods for large replies, in order of preference
+COMPRESSORS = [("zlib", lambda _data: zlib.compress(_data, 1))]
+try:
+    import lz4.frame
+    COMPRESSORS.insert(0, ("lz4", lz4.frame.compress))
+except ImportError:
+    pass
+COMPRESS_THRESHOLD = int(os.environ.get("PYLL_COMPRESS_THRESHOLD", 1 << 16))
+
+conn_info = {'host': 'localhost', 'hostname': gethostname(),
+             'pid': os.getpid(), 'port': port, 'control_port': control_port,
+             'heartbeat_port': heartbeat_port,
+             'ipc': ipc, 'control_ipc': control_ipc,
+             'heartbeat_ipc': heartbeat_ipc,
+             'compression': [_name for _name, _compress in COMPRESSORS]}
+def __register__():
+    # Publish the connection information once virtuoso is ready
+    for _conn_file in (CONN_FILE, REGISTRY_FILE):
+        with open(_conn_file, "w") as COF:
+            json.dump(conn_info, COF)
+
+def __unregister__():
+    if os.path.exists(REGISTRY_FILE):
+        os.remove(REGISTRY_FILE)
+    # Clients waiting for a new server watch CONN_FILE; leave it to a newer
+    # server if one has taken it over
+    try:
+        with open(CONN_FILE, "r") as COF:
+            if json.load(COF).get('pid') == os.getpid():
+                os.remove(CONN_FILE)
+    except (IOError, OSError, ValueError):
+        pass
+
+atexit.register(__unregister__)
+# Make sure the registry entry goes away when virtuoso kills us
+signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
 exit_re = re.compile(r'{*exit\(\)}*')
 exit_payload = ('{"error": null,\n "warning": null,\n "info": "Exiting kernel",'
                 '\n "result": "t"}')
+stream_re = re.compile(r'^<PYLL_STREAM\|([\s\S]*)\|PYLL_STREAM>$')
+more_re = re.compile(r'^<PYLL_MORE\|\|PYLL_MORE>$')
+hello_re = re.compile(r'^<PYLL_HELLO\|([\s\S]*)\|PYLL_HELLO>$')
+interrupt_re = re.compile(r'^<PYLL_INTERRUPT\|([\s\S]*)\|PYLL_INTERRUPT>$')
+
+# Interval (in seconds) at which streamed output is forwarded to the client
+STREAM_INTERVAL = 0.2
+
+# Large results are passed through files in SHM_DIR, a tmpfs if available.
+# Results over PYLL_SHM_MAX bytes go through the pipe to bound tmpfs usage.
+SHM_THRESHOLD = int(os.environ.get("PYLL_SHM_THRESHOLD", 1 << 20))
+SHM_MAX = int(os.environ.get("PYLL_SHM_MAX", 1 << 30))
+SHM_DIR = tempfile.mkdtemp(prefix="pyll-%d-" % os.getpid(),
+                           dir=os.environ.get("PYLL_SHM_DIR") or
+                           ("/dev/shm" if os.path.isdir("/dev/shm") else None))
+atexit.register(shutil.rmtree, SHM_DIR, True)
+
+# Process that evaluates our requests. Virtuoso reports it in __configure__:
+# ipcBeginProcess may start us through a helper, so our parent is only a
+# fallback for virtuoso sessions that cannot tell.
+VIRTUOSO_PID = int(os.environ.get("PYLL_VIRTUOSO_PID", os.getppid()))
+INTERRUPT_SIGNAL = signal.SIGINT
 
-__conn_active__ = False;
-
-def __read_ciw__():
-    # Read results from virtuoso and recreate the JSON payload
-    _read = True
-    _result = []
-    while _read:
-        # Read virtuoso's JSON payload line-by-line
-        _line = sys.stdin.readline().strip()
-        # Terminate read on "PYLL_EOS"
-        if _line == "PYLL_EOS":
-            _read = False
+poller = zmq.Poller()
+poller.register(socket, zmq.POLLIN)
+poller.register(sys.stdin.fileno(), zmq.POLLIN)
+poller.register(control, zmq.POLLIN)
+poller.register(heartbeat, zmq.POLLIN)
+
+
+class CIWReader(object):
+    # Reads virtuoso's replies from a pipe into a preallocated buffer.
+    # Both framings are understood: a "PYLL_LEN <n>" header line followed by
+    # n bytes, or a payload terminated by "\nPYLL_EOS\n". JSON payloads never
+    # start with "P", so the first byte tells the two apart. A "PYLL_SHM"
+    # header line stands for a payload that was written to a file.
+    LEN_HEADER = b"PYLL_LEN "
+    SHM_HEADER = b"PYLL_SHM "
+    EOS = b"\nPYLL_EOS\n"
+    # Replies larger than this are handed to ZMQ without copying
+    DETACH_SIZE = 1 << 16
+
+    def __init__(self, fd, size=1 << 20):
+        self._raw = io.FileIO(fd, "rb", closefd=False)
+        self._size = size
+        self._buf = bytearray(size)
+        # Unread data is always buf[:end]
+        self._end = 0
+        self._scan = 0
+
+    def _fill(self, need=0):
+        # Read what is available into the free tail of the buffer, growing it
+        # to hold at least 'need' bytes
+        _size = max(need, self._end + 1)
+        if _size > len(self._buf):
+            self._buf.extend(bytearray(max(_size, 2 * len(self._buf)) -
+                                       len(self._buf)))
+        _read = self._raw.readinto(memoryview(self._buf)[self._end:])
+        if not _read:
+            raise EOFError("virtuoso closed the pipe")
+        self._end += _read
+
+    def _take(self, start, stop, skip=0):
+        # Return buf[start:stop] and drop everything before 'stop + skip'
+        _rest = self._buf[stop + skip:self._end]
+        if stop - start > self.DETACH_SIZE:
+            # Give this buffer away and continue in a fresh one
+            _payload = memoryview(self._buf)[start:stop]
+            self._buf = bytearray(max(self._size, len(_rest)))
         else:
-            _result.append(_line)
-    return "\n".join(_result)
+            _payload = bytes(self._buf[start:stop])
+        self._buf[:len(_rest)] = _rest
+        self._end = len(_rest)
+        self._scan = 0
+        return _payload
+
+    def read_reply(self):
+        # Block until a complete reply is available and return its payload
+        while True:
+            if self._end == 0:
+                pass
+            elif self._buf[:1] == self.LEN_HEADER[:1]:
+                _eol = self._buf.find(b"\n", 0, self._end)
+                if _eol >= 0 and self._buf[:len(self.SHM_HEADER)] == \
+                        self.SHM_HEADER:
+                    _size, _path = bytes(self._buf[len(self.SHM_HEADER):
+                                                   _eol]).split(b" ", 1)
+                    self._take(_eol + 1, _eol + 1)
+                    return SharedPayload(_path.decode(), int(_size))
+                if _eol >= 0:
+                    _length = int(bytes(self._buf[len(self.LEN_HEADER):_eol]))
+                    _stop = _eol + 1 + _length
+                    if _stop <= self._end:
+                        return self._take(_eol + 1, _stop)
+                    self._fill(_stop)
+                    continue
+            else:
+                _eos = self._buf.find(self.EOS, self._scan, self._end)
+                if _eos >= 0:
+                    return self._take(0, _eos, len(self.EOS))
+                self._scan = max(0, self._end - len(self.EOS) + 1)
+            self._fill()
+
+
+class SharedPayload(object):
+    # A reply that virtuoso wrote to a file in SHM_DIR
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self):
+        # Return the contents and delete the file
+        with open(self.path, "rb") as _shared:
+            _payload = _shared.read()
+        self.discard()
+        return _payload
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Job(object):
+    # A request on its way through virtuoso
+    def __init__(self, session, envelope, message):
+        self.session = session
+        # Routing frames for the reply; None while a streaming client has
+        # not yet asked for the next message, or for internal requests
+        self.envelope = envelope
+        self.message = message
+        self.stream = None
+        self.stream_path = None
+        self.tail = b""
+        self.payload = None
+        # When the request arrived, was sent to virtuoso and was answered
+        self.received = time.time()
+        self.dispatched = None
+        self.answered = None
+
+
+class Session(object):
+    # Per-client state
+    def __init__(self, sid):
+        self.sid = sid
+        self.queue = deque()
+        # Streaming job whose output is still being forwarded to the client
+        self.streaming = None
+        # Client can read files in SHM_DIR
+        self.shm = False
+        # Last SharedPayload sent to the client by reference
+        self.shared = None
+        # Compression method agreed with the client, if any
+        self.encoding = None
+
 
-while True:
-    # Wait for client data
-    message = socket.recv().decode()
-    if __conn_active__ is False:
-        sys.stdout.write('<PYLL_STATUS|printf("New client connected to the PyLLServer\n")|PYLL_STATUS>')
-        sys.stdout.flush()
-        __read_ciw__()
-        __conn_active__ = True
+ciw = CIWReader(sys.stdin.fileno())
+sessions = {}
+# Sessions with queued requests, in the order they get to use virtuoso
+ready = deque()
+# Job currently being evaluated by virtuoso
+active = None
 
 
+def __status_job__(_text):
+    # Print a status line in virtuoso's CIW; the reply is discarded
+    return Job(None, None, '<PYLL_STATUS|printf("%s\n")|PYLL_STATUS>' % _text)
+
+def __send__(_envelope, _kind, *_frames):
+    socket.send_multipart(_envelope + [_kind] + list(_frames), copy=False)
+
+def __meta__(_job, _encoding=None):
+    # Describe where the job's time went and how the payload is encoded
+    _meta = {"timing": {
+        "queue": _job.dispatched - _job.received,
+        "virtuoso": _job.answered - _job.dispatched,
+        "server": time.time() - _job.received}}
+    if _encoding is not None:
+        _meta["encoding"] = _encoding
+    return json.dumps(_meta).encode()
+
+def __compress__(_session, _payload):
+    # Compress a large payload for a client that asked for it
+    if _session.encoding is None or len(_payload) <= COMPRESS_THRESHOLD:
+        return _payload, None
+    return dict(COMPRESSORS)[_session.encoding](_payload), _session.encoding
+
+def __send_reply__(_job):
+    # Send the final reply of a job, by reference if the client can map it
+    _payload = _job.payload
+    if _job.message.startswith("<PYLL_FETCH|"):
+        if isinstance(_payload, SharedPayload):
+            _payload = _payload.read()
+        __send__(_job.envelope, b"reply", __meta__(_job),
+                 *__pack_fetch__(_payload))
+        return
+    if isinstance(_payload, SharedPayload):
+        if _job.session.shm:
+            __abandon_shared__(_job.session)
+            _job.session.shared = _payload
+            __send__(_job.envelope, b"shm", __meta__(_job),
+                     _payload.path.encode(), str(_payload.size).encode())
+            return
+        _payload = _payload.read()
+    _payload, _encoding = __compress__(_job.session, _payload)
+    __send__(_job.envelope, b"reply", __meta__(_job, _encoding), _payload)
+
+def __abandon_shared__(_session):
+    # Delete the file of the session's last reply by reference. The client
+    # deletes it once mapped, so a file still there is one nobody will read.
+    if _session.shared is not None:
+        _session.shared.discard()
+        _session.shared = None
+
+def __enqueue__(_session, _job):
+    _session.queue.append(_job)
+    if _session not in ready:
+        ready.append(_session)
+
+def __flush_stream__(_job):
+    # Forward new output of a streaming job if its client is waiting for it.
+    # Returns True once the final reply has been sent.
+    if _job.envelope is None:
+        return False
+    if _job.stream is not None:
+        _job.tail += _job.stream.read()
+    if _job.tail:
+        __send__(_job.envelope, b"chunk", _job.tail)
+        _job.tail = b""
+        _job.envelope = None
+        return False
+    if _job.payload is None:
+        return False
+    __send_reply__(_job)
+    return True
+
+def __pack_fetch__(_payload):
+    # Split a fetch reply into its header and the values as binary doubles
+    _payload = bytes(_payload)
+    _split = _payload.find(b"\nPYLL_DATA\n")
+    if _split < 0:
+        return [_payload, b""]
+    _values = array("d", map(float, _payload[_split + 11:].split()))
+    if sys.byteorder == "big":
+        _values.byteswap()
+    return [_payload[:_split], _values]
+
+def __close_stream__(_job):
+    _job.tail += _job.stream.read()
+    _job.stream.close()
+    os.remove(_job.stream_path)
+    _job.stream = None
+
+def __write__(_request):
+    # Send a request to virtuoso, preceded by its length in bytes
+    _data = _request.encode("utf-8")
+    _stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    _stdout.write(("PYLL_LEN %d\n" % len(_data)).encode() + _data)
+    _stdout.flush()
+
+def __dispatch__():
+    # Hand the next queued request to virtuoso, taking turns between sessions
+    global active
+    _session = ready.popleft()
+    _job = _session.queue.popleft()
+    if _session.queue:
+        ready.append(_session)
+    _stream_match = stream_re.search(_job.message)
+    if _stream_match:
+        _fd, _job.stream_path = tempfile.mkstemp(prefix="pyll-stream-",
+                                                 suffix=".log")
+        os.close(_fd)
+        _job.stream = open(_job.stream_path, "rb")
+        _session.streaming = _job
+        __write__("<PYLL_STREAM|%s|PYLL_STREAM>%s" %
+                  (_job.stream_path, _stream_match.group(1)))
+    else:
+        __write__(_job.message)
+    _job.dispatched = time.time()
+    active = _job
+
+def __on_reply__():
+    # Virtuoso finished the active job
+    global active
+    _job = active
+    active = None
+    _job.payload = ciw.read_reply()
+    _job.answered = time.time()
+    if _job.envelope is None and _job.stream is None:
+        # Internal request
+        if isinstance(_job.payload, SharedPayload):
+            _job.payload.discard()
+        return
+    if _job.stream is not None:
+        __close_stream__(_job)
+        if __flush_stream__(_job):
+            _job.session.streaming = None
+    else:
+        __send_reply__(_job)
+
+def __on_request__():
+    _frames = socket.recv_multipart()
+    # ROUTER prepends the client's identity; everything up to the empty
+    # delimiter frame is routing information to send back with the reply
+    _split = _frames.index(b"") + 1
+    _envelope = _frames[:_split]
+    _message = _frames[_split].decode()
+    _sid = _frames[0]
+
+    _session = sessions.get(_sid)
+    if _session is None:
+        _session = sessions[_sid] = Session(_sid)
+        _hello = __status_job__("New client connected to the PyLLServer "
+                                "(session %s)" % _sid.decode("ascii", "replace"))
+        __enqueue__(_session, _hello)
+    # A client that sends anything is done with its previous reply
+    __abandon_shared__(_session)
+
+    _job = _session.streaming
+    if _job is not None:
+        if more_re.search(_message):
+            _job.envelope = _envelope
+            if __flush_stream__(_job):
+                _session.streaming = None
+            return
+        # The client gave up on the stream (e.g. after a reset)
+        _session.streaming = None
+        _job.envelope = None
+
+    _hello = hello_re.search(_message)
+    if _hello:
+        # Clients on this host can map large results from SHM_DIR
+        _client = json.loads(_hello.group(1) or "{}")
+        _session.shm = _client.get("hostname") == gethostname()
+        _offered = _client.get("compression", [])
+        _session.encoding = next((_name for _name, _compress in COMPRESSORS
+                                  if _name in _offered), None)
+        __send__(_envelope, b"reply", b"", json.dumps({
+            "session": _sid.decode("ascii", "replace"),
+            "shm": _session.shm,
+            "compression": _session.encoding,
+            "banner": conn_info.get("banner")}).encode())
+        return
+
     # Exit server if requested by client
-    if exit_re.search(message):
-        socket.send_string(exit_payload)
+    if exit_re.search(_message):
+        __send__(_envelope, b"reply", b"", exit_payload.encode())
         # Defer exit to an explicit 'PyLLStopServer()' SKILL procedure
         # # Delete the connection JSON file
         # os.remove(CONN_FILE)
         # exit(0)  # Normal exit
+        del sessions[_sid]
+        __enqueue__(_session, __status_job__(
+            "Client disconnected from the PyLLServer"))
+        return
+
+    __enqueue__(_session, Job(_session, _envelope, _message))
+
+def __on_control__():
+    _match = interrupt_re.search(control.recv().decode())
+    if _match is None or active is None or active.session is None:
+        return
+    # Only the client that owns the running request may interrupt it
+    if _match.group(1) in ("", active.session.sid.decode("ascii", "replace")):
+        os.kill(VIRTUOSO_PID, INTERRUPT_SIGNAL)
+
+
+def __on_heartbeat__():
+    heartbeat.recv()
+    heartbeat.send(json.dumps({"pid": os.getpid(),
+                               "busy": active is not None}).encode())
+
+
+def __configure__():
+    # Tell virtuoso where to put large results and learn its version, which
+    # clients show as their banner without asking virtuoso again, and its
+    # process ID
+    __write__('<PYLL_STATUS|{__pyll_shm_dir__ = %s '
+              '__pyll_shm_threshold__ = %d '
+              '__pyll_shm_max__ = %d}|PYLL_STATUS>' %
+              (json.dumps(SHM_DIR), SHM_THRESHOLD, SHM_MAX))
+    ciw.read_reply()
+    conn_info['banner'] = __ask__('getVersion()')['result']
+    # Where interrupts go, unless PYLL_VIRTUOSO_PID says otherwise
+    global VIRTUOSO_PID
+    _pid = __ask__('PyLLProcessId()')
+    if "PYLL_VIRTUOSO_PID" not in os.environ and _pid['error'] is None and \
+            _pid['result'].isdigit():
+        VIRTUOSO_PID = int(_pid['result'])
+
+
+def __ask__(_code):
+    # Evaluate _code in virtuoso before serving clients; return the payload
+    __write__(_code)
+    _payload = ciw.read_reply()
+    if isinstance(_payload, SharedPayload):
+        _payload = _payload.read()
+    return json.loads(bytes(_payload).decode())
+
+
+def __serve__():
+    while True:
+        _timeout = None
+        if any(_session.streaming is not None
+               for _session in sessions.values()):
+            _timeout = STREAM_INTERVAL * 1000
+        _events = dict(poller.poll(_timeout))
+
+        if heartbeat in _events:
+            __on_heartbeat__()
+        if control in _events:
+            __on_control__()
+        if socket in _events:
+            __on_request__()
+        if sys.stdin.fileno() in _events:
+            if active is not None:
+                __on_reply__()
+            else:
+                # Unsolicited output; nobody to send it to
+                _payload = ciw.read_reply()
+                if isinstance(_payload, SharedPayload):
+                    _payload.discard()
+
+        # Forward output of running streaming jobs
+        for _session in list(sessions.values()):
+            if _session.streaming is not None and \
+                    __flush_stream__(_session.streaming):
+                _session.streaming = None
+
+        if active is None and ready:
+            __dispatch__()
+
 
-        sys.stdout.write('<PYLL_STATUS|printf("Client disconnected from the PyLLServer\n")|PYLL_STATUS>')
-        sys.stdout.flush()
-        __read_ciw__()
-        __conn_active__ = False
-        continue
-
-    # Send the command string to virtuoso
-    sys.stdout.write(message)
-    sys.stdout.flush()
-    json_payload = __read_ciw__()
-    socket.send_string(json_payload)
+try:
+    __configure__()
+    __register__()
+    __serve__()
+except EOFError:
+    pass  # Virtuoso went away
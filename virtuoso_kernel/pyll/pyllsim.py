@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Stand-in for dfII that runs the PyLL server without a Virtuoso licence.
+
+The simulator starts 'pyllserver.py' the way 'PyLLStartServer()' does and
+answers its length-prefixed requests on stdin/stdout like
+'PyLLServerListener' in 'pyllserver.il': tagged status, batch, fetch, typed and streaming requests,
+JSON payloads with "timing", and length-prefixed, "PYLL_EOS" or file
+replies.
+
+Nothing is evaluated. A few expressions the kernel sends get canned answers:
+
+    getVersion()                    a Virtuoso version string
+    PyLLProcessId()                 the simulator's process ID
+    append(listFunctions(...) ...)  a list of --symbols made-up names
+    setof(__s '(...) ...)           the quoted list, as if all were defined
+    help(name)                      a one-line signature for 'name'
+    obj->? / car(obj)~>?            a list of attribute names
+    PyLLAttributes(obj '(...) t)    obj as a cellView, with its attributes
+                                    unless "cellView" is in the list
+    PyLLSimPayload(n)               a string of n bytes
+    PyLLSimSleep(s)                 waits s seconds (interruptible)
+    error("message")                fails with "*Error* message"
+
+Anything else waits --latency seconds and returns a string of --size bytes,
+or t if --size is 0. Fetch requests return --size / 8 values.
+
+Usage: pyllsim.py [--latency S] [--size BYTES] [--symbols N] [--framing F]
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+# Requests longer than a pipe buffer reach us in several reads
+PIPE_BUF = 1 << 16
+
+status_re = re.compile(r'^<PYLL_STATUS\|([\s\S]*)\|PYLL_STATUS>$')
+stream_re = re.compile(r'^<PYLL_STREAM\|([^|]*)\|PYLL_STREAM>([\s\S]*)$')
+batch_re = re.compile(r'^<PYLL_BATCH\|([\s\S]*)\|PYLL_BATCH>$')
+fetch_re = re.compile(r'^<PYLL_FETCH\|([\s\S]*)\|PYLL_FETCH>$')
+typed_re = re.compile(r'^<PYLL_TYPED\|([\s\S]*)\|PYLL_TYPED>$')
+config_re = re.compile(r'(__pyll_\w+__)\s*=\s*("[^"]*"|\S+?)(?=[\s}])')
+help_re = re.compile(r'^help\((\w+)\)$')
+attrs_re = re.compile(r'^(?:car\(\w+\)|\w+)\s*[-~]>\?$')
+typed_attrs_re = re.compile(r"^PyLLAttributes\([\s\S]+ '\(([^)]*)\) \w+\)$")
+payload_re = re.compile(r'^PyLLSimPayload\((\d+)\)$')
+sleep_re = re.compile(r'^(?:\w+\s*=\s*)?PyLLSimSleep\(([\d.]+)\)$')
+timeit_re = re.compile(r'^PyLLTimeit\(lambda\(\(\) [\s\S]*\n\) (\d+) (\d+)\)$')
+profile_re = re.compile(r"^PyLLProfile\(lambda\(\(\) ([\s\S]*)\n\) '(\w+)\)$")
+error_re = re.compile(r'^error\("([^"]*)"\)$')
+
+# Summary of 'PyLLProfile', in the layout of profileSummary
+profile_summary = ('Function Name          calls    total    self\n'
+                   'lambda  1  0.52  0.02\n'
+                   'PyLLSimSleep  3  0.50  0.50\n'
+                   'strcat  12  0.00  0.00\n')
+
+
+class Symbol(str):
+    """
+    A pretend SKILL symbol
+    """
+    pass
+
+
+def print_value(value):
+    """
+    Printed form of a value, like "%L"
+    """
+    if value is None:
+        return 'nil'
+    if value is True:
+        return 't'
+    if isinstance(value, Symbol):
+        return str(value)
+    if isinstance(value, list):
+        return '(%s)' % ' '.join(print_value(_item) for _item in value)
+    return json.dumps(value)
+
+
+def value_json(value):
+    """
+    JSON of a value, like 'PyLLToJSON'
+    """
+    if isinstance(value, Symbol):
+        return {'type': 'symbol', 'name': str(value)}
+    if isinstance(value, list):
+        return [value_json(_item) for _item in value]
+    return value
+
+
+class Simulator(object):
+    """
+    Answers the PyLL server's requests like 'PyLLServerListener'
+    """
+    def __init__(self, latency=0.0, size=0, symbols=5000, framing='length'):
+        super(Simulator, self).__init__()
+        self.latency = latency
+        self.size = size
+        self.framing = framing
+        self.symbols = [Symbol('pyllSim%d' % _num) for _num in range(symbols)]
+        self.attributes = [Symbol(_name) for _name in
+                           ('objType', 'cellView', 'bBox', 'layerPurposePairs',
+                            'libName')]
+        # Set by the server's configuration request
+        self.shm_dir = None
+        self.shm_threshold = 0
+        self.shm_max = 0
+        self.shm_count = 0
+        # Interrupts only abort evaluations, like in dfII
+        self.busy = False
+        signal.signal(signal.SIGINT, self._on_interrupt)
+
+    def _on_interrupt(self, signum, frame):
+        if self.busy:
+            raise KeyboardInterrupt
+
+    def listen(self, data):
+        """
+        Return the framed reply to one request
+        """
+        _status = status_re.search(data)
+        if _status:
+            self._configure(_status.group(1))
+            return self._frame("")
+        _batch = batch_re.search(data)
+        if _batch:
+            return self._frame('[%s]' % ',\n'.join(
+                self.eval(_expr) for _expr in _batch.group(1).split('\x1f')))
+        _fetch = fetch_re.search(data)
+        if _fetch:
+            return self._frame(self.fetch(_fetch.group(1)))
+        _typed = typed_re.search(data)
+        if _typed:
+            return self._frame(self.eval(_typed.group(1), typed=True))
+        _stream = stream_re.search(data)
+        if _stream:
+            return self._frame(self.eval(_stream.group(2), _stream.group(1)))
+        return self._frame(self.eval(data))
+
+    def _configure(self, code):
+        for _name, _value in config_re.findall(code):
+            _value = json.loads(_value) if _value != 'nil' else None
+            if _name == '__pyll_shm_dir__':
+                self.shm_dir = _value
+            elif _name == '__pyll_shm_threshold__':
+                self.shm_threshold = _value
+            elif _name == '__pyll_shm_max__':
+                self.shm_max = _value
+            elif _name == '__pyll_framing__':
+                self.framing = _value
+
+    def eval(self, data, stream_path=None, typed=False):
+        """
+        Return the JSON payload of a (pretend) evaluation of 'data'
+        """
+        _start = time.time()
+        _info = None
+        _error = None
+        data = data.strip()
+        if data.startswith('{') and data.endswith('}'):
+            data = data[1:-1].strip()
+        self.busy = True
+        try:
+            time.sleep(self.latency)
+            _failure = error_re.search(data)
+            if _failure:
+                _result = None
+                _error = '*Error* %s' % _failure.group(1)
+            else:
+                _result = self._result(data)
+            _help = help_re.search(data)
+            if _help:
+                _info = '%s( g_value [?option g_option] ) => t\n' % \
+                    _help.group(1)
+            if stream_path is not None:
+                with open(stream_path, 'w') as _stream:
+                    _stream.write('pretend output of %s\n' % data[:40])
+        except KeyboardInterrupt:
+            _result = None
+            _error = '*Error* Interrupted'
+        finally:
+            self.busy = False
+        if typed:
+            _result = value_json(_result)
+        elif not isinstance(_result, str) or isinstance(_result, Symbol):
+            _result = print_value(_result)
+        _elapsed = time.time() - _start
+        return json.dumps({'error': _error, 'warning': None, 'info': _info,
+                           'result': _result,
+                           'timing': {'eval': _elapsed, 'user': _elapsed}})
+
+    def _result(self, data):
+        # Value of 'data'
+        if data == 'getVersion()':
+            return ('@(#)$CDS: virtuoso version 6.1.8-64b 01/01/2020 '
+                    '(pyllsim) $')
+        if data == 'PyLLProcessId()':
+            return os.getpid()
+        if data.startswith('append(listFunctions('):
+            return self.symbols
+        if data.startswith('setof(__s '):
+            return [Symbol(_name) for _name in
+                    re.search(r"'\(([^)]*)\)", data).group(1).split()]
+        if help_re.search(data):
+            return True
+        if attrs_re.search(data):
+            return self.attributes
+        _typed_attrs = typed_attrs_re.search(data)
+        if _typed_attrs:
+            if '"cellView"' in _typed_attrs.group(1).split():
+                return [['cellView', None]]
+            return [['cellView', self.attributes]]
+        _payload = payload_re.search(data)
+        if _payload:
+            return 'x' * int(_payload.group(1))
+        _timeit = timeit_re.search(data)
+        if _timeit:
+            # (number elapsed1 elapsed2 ...), about 1 us per loop
+            _number = int(_timeit.group(1)) or 100000
+            return [_number] + [_number * (1e-6 + _run * 1e-8)
+                                for _run in range(int(_timeit.group(2)))]
+        _profile = profile_re.search(data)
+        if _profile:
+            # (summary ok value), kept when the profiled code fails
+            _summary = profile_summary
+            _error = error_re.search(_profile.group(1).strip('{} \n'))
+            if _error:
+                return [_summary, None, '*Error* %s' % _error.group(1)]
+            _value = self._result(_profile.group(1).strip('{} \n'))
+            return [_summary, True,
+                    _value if isinstance(_value, str) and
+                    not isinstance(_value, Symbol) else print_value(_value)]
+        _sleep = sleep_re.search(data)
+        if _sleep:
+            time.sleep(float(_sleep.group(1)))
+            return True
+        return 'x' * self.size if self.size else True
+
+    def fetch(self, data):
+        """
+        Return a fetch reply with --size / 8 numbers
+        """
+        _count = max(self.size // 8, 1)
+        time.sleep(self.latency)
+        return ('{"error": null, "warning": null, "info": null, '
+                '"result": "%d"}\nPYLL_DATA\n%s' %
+                (_count, ' '.join('%.17g' % (_num * 0.5)
+                                  for _num in range(_count))))
+
+    def _frame(self, payload):
+        # Frame a reply like 'PyLLWriteReply'
+        _payload = payload.encode('utf-8')
+        if self.framing != 'length':
+            return _payload + b'\nPYLL_EOS\n'
+        if self.shm_dir and \
+                self.shm_threshold < len(_payload) <= self.shm_max:
+            self.shm_count += 1
+            _path = '%s/%d.json' % (self.shm_dir, self.shm_count)
+            with open(_path, 'wb') as _shared:
+                _shared.write(_payload)
+            return ('PYLL_SHM %d %s\n' % (len(_payload), _path)).encode()
+        return ('PYLL_LEN %d\n' % len(_payload)).encode() + _payload
+
+
+class RequestReader(object):
+    """
+    Collects the pieces of the server's length-prefixed requests, like
+    'PyLLServerListener'
+    """
+    def __init__(self, fd):
+        super(RequestReader, self).__init__()
+        self.fd = fd
+        self.buffer = bytearray()
+
+    def read(self):
+        """
+        Return the next request, or None when the server has gone
+        """
+        while True:
+            _end = self.buffer.find(b'\n')
+            if _end >= 0:
+                _size = int(self.buffer[:_end].split()[1])
+                if len(self.buffer) > _end + _size:
+                    _request = bytes(self.buffer[_end + 1:_end + 1 + _size])
+                    del self.buffer[:_end + 1 + _size]
+                    return _request
+            _data = os.read(self.fd, PIPE_BUF)
+            if not _data:
+                return None
+            self.buffer += _data
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Stand-in for dfII that '
+                                      'runs and answers the PyLL server')
+    _parser.add_argument('--latency', type=float, default=0.0,
+                         help='seconds each evaluation takes')
+    _parser.add_argument('--size', type=int, default=0,
+                         help='bytes in the result of other expressions')
+    _parser.add_argument('--symbols', type=int, default=5000,
+                         help='number of function and variable names')
+    _parser.add_argument('--framing', choices=('length', 'eos'),
+                         default='length', help='reply framing')
+    _parser.add_argument('--server', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'pyllserver.py'),
+        help='PyLL server script to run')
+    _args = _parser.parse_args()
+
+    _sim = Simulator(_args.latency, _args.size, _args.symbols, _args.framing)
+    _server = subprocess.Popen([sys.executable, _args.server],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Stop the server along with us
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    _requests = RequestReader(_server.stdout.fileno())
+    try:
+        while True:
+            _data = _requests.read()
+            if _data is None:
+                break
+            _server.stdin.write(_sim.listen(_data.decode('utf-8')))
+            _server.stdin.flush()
+    except IOError:
+        pass  # The server went away
+    finally:
+        if _server.poll() is None:
+            _server.terminate()
+        _server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,36 @@ To be used in conjunction with IPython/Jupyter.
 """
 import zmq
 import json
+import codecs
+import time
+import uuid
+import mmap
+import os
+import zlib
+from socket import gethostname
 from jupyter_core.paths import jupyter_data_dir
 import re
 import colorama
+from .cache import SortedNames, LRUCache
+from .values import from_json
+from .lexer import Lexer
+
+# Decoders for compressed replies, by the name the server gives them
+_decompressors = {'zlib': zlib.decompress}
+try:
+    import lz4.frame
+    _decompressors['lz4'] = lz4.frame.decompress
+except ImportError:
+    pass
+
+def load_connection_file(conn_file=None):
+    """
+    Read a PyLL server's connection file, by default the latest server's
+    """
+    with open(conn_file or (jupyter_data_dir() + "/runtime/" +
+                            "virtuoso-pyll.json"), "r") as COF:
+        return json.load(COF)
+
 
 class VirtuosoExceptions(Exception):
     """
@@ -21,42 +48,314 @@ class VirtuosoExceptions(Exception):
         return repr(self.value)
 
 
+class VirtuosoTimeout(VirtuosoExceptions):
+    """
+    Raised when dfII does not reply within the allotted time
+    """
+    pass
+
+
+class VirtuosoConnectionLost(VirtuosoExceptions):
+    """
+    Raised when the PyLL server stops answering heartbeats, or no server can
+    be reached
+    """
+    pass
+
+
 class VirtuosoShellClient(object):
     """
     This is the client that talks to dfII's python server
     """
-    def __init__(self, port=None):
+    # Seconds without a reply after which the server's heartbeat is checked
+    heartbeat_interval = 1.0
+    # Seconds to wait for each heartbeat, and the number of heartbeats in a
+    # row that may go unanswered before the server is given up for dead
+    heartbeat_timeout = 1.0
+    heartbeat_misses = 3
+
+    def __init__(self, port=None, conn_file=None):
         super(VirtuosoShellClient, self).__init__()
+        self.conn_file = conn_file
         self.port = None
         self.host = None
+        self.control_port = None
+        # ZMQ endpoints of the server's request and control sockets
+        self.endpoint = None
+        self.control_endpoint = None
+        self.heartbeat_endpoint = None
+        # Process ID of the server, as its connection file gives it
+        self.server_pid = None
+        # Compression methods to offer the server and the one it chose
+        self.compression = []
+        self.encoding = None
+        # The server's reply to our hello
+        self.capabilities = {}
+        # Identifies this client's requests to a shared server
+        self.session = uuid.uuid4().hex
         self.context = None
         self.socket = None
+        self.control = None
+        self.heartbeat = None
+        self.poller = None
+        # Set once the server has stopped answering; the client is unusable
+        self.lost = False
+        # Send-to-reply time and server metadata of the last reply
+        self.last_round_trip = None
+        self.last_meta = {}
+        self._sent = None
+        # True while a request waits for its final reply
+        self.pending = False
         self.init()
 
     def init(self):
         # Get connection info from the PyLL JSON file
-        CONN_FILE = jupyter_data_dir() + "/runtime/" + "virtuoso-pyll.json"
-        with open(CONN_FILE, "r") as COF:
-            self.host, self.port = json.load(COF)
+        _conn = load_connection_file(self.conn_file)
+        if not isinstance(_conn, dict):
+            # Servers that wrote [host, port] send single-frame replies
+            raise VirtuosoExceptions(("ConnectionError", 0,
+                                      "The PyLL server is too old for this "
+                                      "kernel; load the current "
+                                      "pyllserver.il and restart it"))
+        self.host = _conn['host']
+        self.port = _conn.get('port')
+        self.control_port = _conn.get('control_port')
+        self.server_pid = _conn.get('pid')
+        if _conn.get('hostname', gethostname()) != gethostname():
+            # Server runs on another machine sharing our runtime dir;
+            # large replies are worth compressing on the way
+            self.host = _conn['hostname']
+            self.compression = [_name for _name in
+                                _conn.get('compression', [])
+                                if _name in _decompressors]
+        elif _conn.get('ipc') is not None:
+            # Unix sockets skip the TCP stack on the same host
+            self.endpoint = _conn['ipc']
+            self.control_endpoint = _conn.get('control_ipc')
+            self.heartbeat_endpoint = _conn.get('heartbeat_ipc')
+        if self.endpoint is None:
+            if self.port is None:
+                raise VirtuosoExceptions(("ConnectionError", 0,
+                                          "The PyLL server on %s only "
+                                          "accepts local clients" %
+                                          self.host))
+            self.endpoint = "tcp://%s:%d" % (self.host, self.port)
+            if self.control_port is not None:
+                self.control_endpoint = "tcp://%s:%d" % (self.host,
+                                                         self.control_port)
+            if _conn.get('heartbeat_port') is not None:
+                self.heartbeat_endpoint = "tcp://%s:%d" % (
+                    self.host, _conn['heartbeat_port'])
         # Connection info will come from a JSON file generated by the dfII/PyLL
         # server. So, read JSON to figure out the connection info.
         self.context = zmq.Context()
+        self.heartbeat = None
+        self.lost = False
+        self._connect()
+        if self.control_endpoint is not None:
+            self.control = self.context.socket(zmq.PUSH)
+            self.control.setsockopt(zmq.LINGER, 0)
+            self.control.connect(self.control_endpoint)
+        try:
+            # A connection file left behind by a dead server costs one
+            # heartbeat rather than a hello that is never answered
+            if self.ping() is None:
+                raise VirtuosoConnectionLost((
+                    "ConnectionError", 0, "The PyLL server at %s does not "
+                    "answer" % self.endpoint))
+            self.hello()
+        except Exception:
+            self.close()
+            raise
+
+    def hello(self):
+        """
+        Introduce this client to the server and learn its capabilities
+        """
+        self.write('<PYLL_HELLO|%s|PYLL_HELLO>' %
+                   json.dumps({'hostname': gethostname(),
+                               'compression': self.compression}))
+        self.capabilities = self.read_parsed()
+        self.encoding = self.capabilities.get('compression')
+        return self.capabilities
+
+    def reset(self):
+        """
+        Replace a REQ socket that is stuck waiting for a reply.
+
+        Any late reply to the abandoned request is dropped by ZMQ.
+        """
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
+        self.pending = False
+        self._connect()
+
+    def _connect(self):
         self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect("tcp://%s:%d" % (self.host, self.port))
+        self.socket.setsockopt(zmq.IDENTITY, self.session.encode('ascii'))
+        # Tag requests so that late replies to abandoned requests are dropped
+        self.socket.setsockopt(zmq.REQ_CORRELATE, 1)
+        self.socket.setsockopt(zmq.REQ_RELAXED, 1)
+        self.socket.connect(self.endpoint)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def ping(self, timeout=None):
+        """
+        Check the server's heartbeat.
+
+        Returns the server's answer, a dict with its 'pid' and whether dfII
+        is 'busy', or None if it did not answer within *timeout* seconds
+        (`heartbeat_timeout` by default). Servers without a heartbeat socket
+        are assumed to be alive.
+        """
+        if self.heartbeat_endpoint is None:
+            return {}
+        if self.heartbeat is None:
+            self.heartbeat = self.context.socket(zmq.REQ)
+            self.heartbeat.setsockopt(zmq.LINGER, 0)
+            # Unanswered pings must not block the next one
+            self.heartbeat.setsockopt(zmq.REQ_CORRELATE, 1)
+            self.heartbeat.setsockopt(zmq.REQ_RELAXED, 1)
+            self.heartbeat.connect(self.heartbeat_endpoint)
+        self.heartbeat.send(b'ping')
+        if timeout is None:
+            timeout = self.heartbeat_timeout
+        if not self.heartbeat.poll(int(timeout * 1000)):
+            return None
+        return json.loads(self.heartbeat.recv().decode())
+
+    def _replaced(self):
+        # True if the connection file now names another server
+        try:
+            _conn = load_connection_file(self.conn_file)
+        except (IOError, ValueError):
+            return False
+        return isinstance(_conn, dict) and _conn.get('pid') != self.server_pid
+
+    def _wait(self, timeout=None):
+        """
+        Wait until a reply arrives, for at most *timeout* seconds if given.
+
+        While no reply comes, the server's heartbeat is checked every
+        `heartbeat_interval` seconds. VirtuosoConnectionLost is raised once
+        `heartbeat_misses` heartbeats in a row went unanswered, or at the
+        first one if another server has taken over the connection file.
+        """
+        _deadline = None
+        if timeout is not None:
+            _deadline = time.time() + timeout
+        _misses = 0
+        while True:
+            _wait = self.heartbeat_interval
+            if _deadline is not None:
+                _wait = min(_wait, max(0, _deadline - time.time()))
+            if self.poller.poll(int(_wait * 1000)):
+                return
+            if _deadline is not None and time.time() >= _deadline:
+                raise VirtuosoTimeout(("TimeoutError", timeout,
+                                       "No reply from dfII within %g s" %
+                                       timeout))
+            if self.ping() is not None:
+                _misses = 0
+                continue
+            _misses += 1
+            if _misses >= self.heartbeat_misses or self._replaced():
+                self.lost = True
+                raise VirtuosoConnectionLost((
+                    "ConnectionError", 0,
+                    "The PyLL server at %s stopped answering; the kernel "
+                    "will reconnect on the next request" % self.endpoint))
+
+    def interrupt(self):
+        """
+        Ask the server to abort the running evaluation
+        """
+        if self.control is not None:
+            self.control.send_string('<PYLL_INTERRUPT|%s|PYLL_INTERRUPT>' %
+                                     self.session)
 
     def write(self, payload):
         #TODO: make sure the payload type is correct
+        self._sent = time.time()
+        self.pending = True
         self.socket.send_string(payload)
 
-    def read(self):
-        return self.socket.recv().decode()
+    def _recv(self, timeout=None):
+        self._wait(timeout)
+        _frames = self.socket.recv_multipart()
+        if _frames[0] != b'chunk':
+            # Final replies carry the server's metadata after their kind
+            self.last_round_trip = time.time() - self._sent
+            self.pending = False
+            _meta = _frames.pop(1)
+            self.last_meta = json.loads(_meta.decode()) if _meta else {}
+            _encoding = self.last_meta.get('encoding')
+            if _encoding is not None:
+                _frames[1] = _decompressors[_encoding](_frames[1])
+        if _frames[0] == b'shm':
+            # Large result left in a shared file by dfII: map it and remove
+            # the file, the mapping stays valid until closed
+            _path = _frames[1].decode()
+            with open(_path, 'rb') as _shared:
+                _mapped = mmap.mmap(_shared.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            os.remove(_path)
+            _frames = [b'reply', _mapped]
+        return _frames
+
+    @staticmethod
+    def _text(frame):
+        # Decode a reply frame, releasing shared memory
+        _text = codecs.utf_8_decode(frame)[0]
+        if isinstance(frame, mmap.mmap):
+            frame.close()
+        return _text
 
-    def read_parsed(self):
-        return json.loads(self.socket.recv().decode())
+    def read(self, timeout=None):
+        return self._text(self._recv(timeout)[1])
+
+    def read_frames(self, timeout=None):
+        """
+        Return all data frames of the next reply
+        """
+        return self._recv(timeout)[1:]
+
+    def read_parsed(self, timeout=None):
+        return json.loads(self.read(timeout))
+
+    def read_stream(self, callback, timeout=None):
+        """
+        Read the reply to a streaming request.
+
+        Partial output is passed to *callback* as it arrives and the final
+        payload is returned. *timeout* applies to the whole reply.
+        """
+        _decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        _deadline = None
+        if timeout is not None:
+            _deadline = time.time() + timeout
+        while True:
+            _timeout = None
+            if _deadline is not None:
+                _timeout = max(0, _deadline - time.time())
+            try:
+                _kind, _payload = self._recv(_timeout)[:2]
+            except VirtuosoTimeout:
+                # Report the whole allowance, not what was left of it
+                raise VirtuosoTimeout(("TimeoutError", timeout,
+                                       "No reply from dfII within %g s" %
+                                       timeout))
+            if _kind != b'chunk':
+                return self._text(_payload)
+            _text = _decoder.decode(_payload)
+            self.socket.send_string('<PYLL_MORE||PYLL_MORE>')
+            if _text:
+                callback(_text)
 
     def close(self):
-        # Close socket
-        self.socket.close()
+        # Close all sockets without waiting for unsent requests
+        self.context.destroy(linger=0)
 
 class VirtuosoShell(object):
     """
@@ -65,22 +364,156 @@ class VirtuosoShell(object):
     _banner = None
     _version_re = None
     _output = ""
+    _client = None
+    _completions = None
+    _pool = None
+    # Round trip, server and dfII timings of the last cell
+    last_timing = None
+    # Per-cell timeout in seconds (None waits forever)
+    timeout = None
+    # Time allowed for dfII to abort after an interrupt before the
+    # connection is reset
+    interrupt_grace = 5.0
+    # Seconds to keep looking for a PyLL server before a request fails, and
+    # the first and longest waits between attempts. Requests only wait while
+    # wait_for_server is set; otherwise a single attempt is made.
+    wait_for_server = False
+    reconnect_timeout = 30.0
+    reconnect_delay = 0.25
+    reconnect_max_delay = 8.0
+    # 'disconnected', 'connecting', 'connected' or 'lost'
+    connection_state = 'disconnected'
+    # Called with a message whenever connection_state changes, e.g. to show
+    # it in the notebook
+    on_connection_state = None
 
     @property
     def banner(self):
         """
-        Virtuoso shell's banner
+        Virtuoso shell's banner, as the server reported it at startup.
+
+        Before a connection, and without a connection file that has it, a
+        placeholder is returned rather than waiting for a server.
         """
-        self._shell.write("getVersion()")
-        self._banner = self._shell.read_parsed()['result']
+        if self._banner is None:
+            self._banner = self.server_info.get('banner')
+        if self._banner is None and self._client is not None and \
+                not self._client.lost:
+            # Servers that do not report it
+            self.run_raw("getVersion()")
+            self._banner = json.loads(self._output)['result']
+        if self._banner is None:
+            return 'Virtuoso (not connected)'
         return self._banner
 
+    @property
+    def server_info(self):
+        """
+        What the server says about itself: its hello reply once connected,
+        its connection file before
+        """
+        if self._client is not None:
+            return self._client.capabilities
+        try:
+            _conn = load_connection_file()
+        except (IOError, ValueError):
+            return {}
+        return _conn if isinstance(_conn, dict) else {}
+
+    @property
+    def _shell(self):
+        # Connect on first use, so that the kernel starts without waiting,
+        # and again after the server was lost
+        if self._client is not None and self._client.lost:
+            self._drop_client()
+        if self._client is None:
+            self._client = self._connect()
+        return self._client
+
+    def _set_connection_state(self, state, message):
+        # Retries are reported once, not at every attempt
+        _changed = state != self.connection_state
+        self.connection_state = state
+        if _changed and self.on_connection_state is not None:
+            self.on_connection_state(message)
+
+    def _drop_client(self):
+        # Forget a server that stopped answering, and what we learnt from
+        # it: a new dfII has its own procedures and version
+        self._client.close()
+        self._client = None
+        self._completions = None
+        self._banner = None
+        self._info_cache.clear()
+        self._attribute_cache.clear()
+        self._local_names.clear()
+        self._local_keywords.clear()
+        self._set_connection_state('lost', 'Lost the connection to the '
+                                   'PyLL server')
+
+    @staticmethod
+    def _conn_file_state():
+        # Changes whenever a server (re)writes the connection file
+        try:
+            _stat = os.stat(jupyter_data_dir() + "/runtime/" +
+                            "virtuoso-pyll.json")
+        except OSError:
+            return None
+        return (_stat.st_mtime, _stat.st_size, _stat.st_ino)
+
+    def _connect(self):
+        """
+        Connect to the PyLL server named by the connection file.
+
+        If `wait_for_server` is set, failed attempts are retried with
+        exponential backoff for up to `reconnect_timeout` seconds. The
+        connection file is watched in the
+        meantime, so a server that starts, e.g. on a new port after dfII
+        was restarted, is tried at once.
+        """
+        _deadline = time.time()
+        if self.wait_for_server:
+            _deadline += self.reconnect_timeout
+        _delay = self.reconnect_delay
+        while True:
+            _state = self._conn_file_state()
+            try:
+                _client = VirtuosoShellClient()
+            except VirtuosoExceptions as _error:
+                _reason = _error.value[2]
+            except (IOError, OSError, ValueError, KeyError,
+                    zmq.ZMQError) as _error:
+                _reason = str(_error)
+            else:
+                if self.connection_state != 'disconnected':
+                    self._set_connection_state(
+                        'connected', 'Connected to the PyLL server (pid %s)'
+                        % _client.server_pid)
+                self.connection_state = 'connected'
+                return _client
+            if time.time() + _delay > _deadline:
+                self._set_connection_state(
+                    'disconnected', 'No PyLL server found')
+                raise VirtuosoConnectionLost((
+                    "ConnectionError", 0,
+                    "No PyLL server answered (%s). Run PyLLStartServer() "
+                    "in Virtuoso." % _reason))
+            self._set_connection_state(
+                'connecting', 'Waiting for a PyLL server (%s)' % _reason)
+            _retry = time.time() + _delay
+            while time.time() < _retry and \
+                    self._conn_file_state() == _state:
+                time.sleep(0.1)
+            _delay = min(2 * _delay, self.reconnect_max_delay)
+
     @property
     def language_version(self):
         """
-        Language version
+        Language version, or None while it is not known
         """
         __match__ = self._version_re.search(self.banner)
+        if __match__ is None:
+            return None
         return __match__.group(1)
 
     @property
@@ -97,32 +530,31 @@ class VirtuosoShell(object):
         self._shell_available_re = re.compile(r'"__jupyter_kernel_ready__"'
                                               r'[\s\S]+')
         self._version_re = re.compile(r'version (\d+(\.\d+)+)')
-        self._multiline_re = re.compile(r'[^\\]\n')
         self._error_re = re.compile(r'^([\s\S]*?)\*Error\*'
                                     r'(.+)(\s*)([\s\S]*)')
-        self._open_braces_re = re.compile(r'\{')
-        self._close_braces_re = re.compile(r'\}')
-        self._open_paren_re = re.compile(r'\(')
-        self._close_paren_re = re.compile(r'\)')
-        self._dbl_quote_re = re.compile(r'"')
         self._output_prompt_re = re.compile(r'<<pyvi>> ')
-        self._object_prop_re = re.compile(r'(\w+?)\s*([-~]>)(\w*?)$')
-        self._object_prop_list_re = re.compile(r'\((\w+?)\)\s*([-~]>)(\w*?)$')
-        self._var_name_re = re.compile(r'\s*(\w+)$')
-        self.match_dict = {self._object_prop_re: lambda _match: '%s%s?' %
-                           (_match.group(1), _match.group(2)),
-                           self._object_prop_list_re: lambda _match:
-                           'car(%s)%s?' % (_match.group(1), _match.group(2)),
-                           self._var_name_re: lambda _match:
-                           'listFunctions("^%s" t)\r\nlistVariables("^%s")' %
-                           (_match.group(1), _match.group(1))}
+        # Functions that may be evaluated to find the object before '->' or
+        # '~>' when completing its attributes: they have no side effects
+        self._accessors = ('car', 'cdr', 'cadr', 'caddr', 'cddr', 'last',
+                           'nth')
+        self._opt_keyword_re = re.compile(r'(\?\w+)')
+        # token -> (raw help text, pretty-printed help text)
+        self._info_cache = LRUCache(maxsize=512)
+        # Names bound and keyword arguments defined by executed cells
+        self._local_names = set()
+        self._local_keywords = {}
+        # objType of database objects -> their attributes, for '->' and '~>'
+        self._attribute_cache = {}
+        # Tokens of the code being completed, extended as the user types
+        self._complete_lexer = None
         self._start_virtuoso()
 
     def _start_virtuoso(self):
         """
-        Connect to the virtuoso shell
+        Connect to the virtuoso shell when it is first needed
         """
-        self._shell = VirtuosoShellClient()
+        self._client = None
+        self._banner = None
 
     def _parse_output(self):
         """
@@ -134,10 +566,23 @@ class VirtuosoShell(object):
             (etype, evalue, tb)
         else, set to None
         """
-        err_out = self._output['error']
-        warn_out = self._output['warning']
-        info_out = self._output['info']
-        res_out = self._output['result']
+        self._output, _exec_error = self._format_payload(self._output)
+
+        # If the shell reported any errors, throw exception
+        if _exec_error is not None:
+            raise VirtuosoExceptions(_exec_error)
+
+    def _format_payload(self, payload):
+        """
+        Render a reply payload as text.
+
+        Returns the text and the error tuple (etype, evalue, tb), or None if
+        dfII did not report an error.
+        """
+        err_out = payload['error']
+        warn_out = payload['warning']
+        info_out = payload['info']
+        res_out = payload['result']
         full_out = ""
         _err_match = None
 
@@ -155,12 +600,9 @@ class VirtuosoShell(object):
         if res_out is not None:
             full_out += res_out
 
-        self._output = full_out
-
-        # If the shell reported any errors, throw exception
         if _err_match is not None:
-            _exec_error = ("Error", 1, _err_match.group(2))
-            raise VirtuosoExceptions(_exec_error)
+            return full_out, ("Error", 1, _err_match.group(2))
+        return full_out, None
 
         #self._exec_error = None
         #_err_match = self._error_re.search(self._output)
@@ -202,12 +644,50 @@ class VirtuosoShell(object):
         #if self._exec_error is not None:
         #    raise VirtuosoExceptions(self._exec_error)
 
+    @property
+    def completions(self):
+        """
+        Sorted list of all function and variable names known to dfII.
+
+        The tables are fetched in a single round trip on first use.
+        """
+        if self._completions is None:
+            # Plain strings rather than values.Symbol
+            self._completions = SortedNames(
+                str(_name) for _name in self.evaluate(
+                    'append(listFunctions("." t) listVariables("."))') or [])
+        return self._completions
+
+    def update_completions(self, code):
+        """
+        Add the procedures and globals defined by an executed cell to the
+        completion names.
+
+        Only the names that *code* binds or assigns are checked with dfII,
+        so this costs at most one short round trip.
+        """
+        _lexer = Lexer(code)
+        _local_names, _local_keywords = _lexer.definitions()
+        self._local_names.update(_local_names)
+        self._local_keywords.update(_local_keywords)
+        _names = _local_names.union(_lexer.assignments())
+        # Re-defined procedures get fresh help text on the next inspection
+        for _name in _names:
+            self._info_cache.invalidate(_name)
+        if self._completions is None or not _names:
+            return _names
+        _new = [_name for _name in _names if _name not in self._completions]
+        if _new:
+            self._completions.update(str(_name) for _name in self.evaluate(
+                "setof(__s '(%s) or(isCallable(__s) boundp(__s)))" %
+                ' '.join(_new)) or [])
+        return _names
+
     def _pretty_introspection(self, info, keyword):
-        import re
         # Optional keywords
-        info = re.sub(r'(\?\w+)', r'%s\1%s' % (colorama.Fore.YELLOW,
-                                               colorama.Fore.RESET), info,
-                      count=0)
+        info = self._opt_keyword_re.sub(r'%s\1%s' % (colorama.Fore.YELLOW,
+                                                     colorama.Fore.RESET),
+                                       info, count=0)
         # Required arguments
         info = re.sub(r'(\s*)(%s\()([\r\n]*)([\w\s]+)([\s\S]+)' % keyword,
                       r'\1\2\3%s\4%s\5' % (colorama.Fore.GREEN,
@@ -227,60 +707,320 @@ class VirtuosoShell(object):
         post-processed in this function.
         """
         self._shell.write(code)
-        self._output = self._shell.read()
+        self._output = self._read_reply(parsed=False)
+
+    def _read_reply(self, parsed=True):
+        """
+        Read the reply to the last request, for at most `timeout` seconds.
+
+        dfII is interrupted if the reply takes longer, as for cells.
+        """
+        try:
+            if parsed:
+                return self._shell.read_parsed(self.timeout)
+            return self._shell.read(self.timeout)
+        except VirtuosoTimeout:
+            self._output = ""
+            self.interrupt()
+            raise
+
+    def evaluate(self, expression):
+        """
+        Return the value of *expression* as native Python data.
 
-    def run_cell(self, code):
+        dfII serializes the value with 'PyLLToJSON'; see `values.from_json`
+        for how SKILL types map to Python.
+        """
+        self._shell.write("<PYLL_TYPED|" + expression + "|PYLL_TYPED>")
+        _pay = self._read_reply()
+        if _pay['error'] is not None:
+            self._output, _exec_error = self._format_payload(
+                dict(_pay, result=None))
+            raise VirtuosoExceptions(_exec_error or
+                                     ("Error", 1, _pay['error']))
+        return from_json(_pay['result'])
+
+    def _checked_expression(self, code):
+        """
+        Return *code* as a single expression for `evalstring`.
+
+        Code that dfII's reader could not finish, such as an unclosed
+        bracket or string, raises a SyntaxError before it is sent. Several
+        top-level lines are wrapped in `{...}` so that all of them run.
+        """
+        _lexer = Lexer(code)
+        _error = _lexer.error()
+        if _error is not None:
+            self._output = ""
+            raise VirtuosoExceptions(("SyntaxError", 1, _error))
+        if _lexer.is_multiline():
+            # On its own line, the brace is not swallowed by a ';' comment
+            code = "{" + code + "\n}"
+        return code
+
+    def run_cell(self, code, stream=None):
         """
         Executes the 'code'.
 
         We need to wrap a block of SKILL code in `prog` or equivalently in
         `{...}` for `evalstring` to work correctly on the dfII side.
-        """
 
-        if self._multiline_re.search(code):
-            self._shell.write("{" + code + "}")
-        else:
-            self._shell.write(code)
-        self.wait_ready()
+        If *stream* is given, it is called with the cell's printed output
+        while the cell is still running.
+        """
+        code = self._checked_expression(code)
+        if stream is not None:
+            code = "<PYLL_STREAM|" + code + "|PYLL_STREAM>"
+        self._shell.write(code)
+        self.wait_ready(stream)
 
         # Check the output and throw exception in case of error
         self._parse_output()
 
         return self.output
 
-    def get_matches(self, code_line):
-        """
-        Return a list of functions and variables matching the line's end or
-        in case of '->' or '~>', a list of attributes.
-        """
-        _cmd = None
-        _token = ''
-        _match_list = []
-        _match = self._object_prop_re.search(code_line)
-        _raw_mode = True
-        if(_match is None):
-            _match = self._object_prop_list_re.search(code_line)
-        if(_match is None):
-            _match = self._var_name_re.search(code_line)
-            _raw_mode = False
-        if(_match is not None):
-            _cmd = self.match_dict[_match.re](_match)
-            _token = _match.group(1)
-            self.run_raw(_cmd)
-            _output = json.loads(self._output)['result']
-            if _output != u'nil':
-                _output = _output.replace('(', ' ')
-                _output = _output.replace(')', ' ')
-                _output = _output.replace('nil', ' ')
-                _match_list = _output.split()
-                if(len(_match.groups()) == 3):
-                    # when there is part of an attr.
-                    _token = _match.group(3)
-                    if(_token != ''):
-                        _match_list = [_match for _match in _match_list if
-                                       _match.startswith(_token)]
-
-        return((_match_list, _token))
+    def run_batch(self, expressions):
+        """
+        Evaluate many expressions in a single round trip.
+
+        Returns one record per expression: a dict with the 'error',
+        'warning', 'info' and 'result' fields of the dfII reply.
+        """
+        if not expressions:
+            return []
+        _exprs = [self._checked_expression(_expr) for _expr in expressions]
+        # Expressions are separated by the ASCII unit separator
+        self._shell.write("<PYLL_BATCH|" + "\x1f".join(_exprs) +
+                          "|PYLL_BATCH>")
+        self.wait_ready()
+        return self._output
+
+    def timeit(self, code, number=0, repeat=7):
+        """
+        Time *code* with dfII's own timers, excluding the transport.
+
+        The code runs *number* times in each of *repeat* runs; a *number*
+        of 0 lets dfII choose one so that a run lasts at least 0.2 s.
+        Returns the number of loops per run and the list of run times in
+        seconds.
+        """
+        _values = self.evaluate('PyLLTimeit(lambda(() %s\n) %d %d)' %
+                                (self._checked_expression(code), number,
+                                 repeat))
+        # (number elapsed1 elapsed2 ...); dfII may be running an older
+        # PyLLTimeit, or one that returns something else
+        _numbers = isinstance(_values, list) and all(
+            isinstance(_value, (int, float)) and not isinstance(_value, bool)
+            for _value in _values)
+        if not _numbers or len(_values) != repeat + 1 or _values[0] < 1:
+            raise VirtuosoExceptions(
+                ("Error", 1, "Unexpected reply from PyLLTimeit: %r" %
+                 (_values,)))
+        return int(_values[0]), [float(_time) for _time in _values[1:]]
+
+    def profile(self, code, mode='time'):
+        """
+        Run *code* like `run_cell` under the SKILL profiler.
+
+        *mode* is 'time' or 'memory'. Returns the text of the profile
+        summary, which dfII sends back in its reply, and the cell's error
+        tuple, or None if the cell succeeded. The summary is returned even
+        when the cell fails, and the cell's output is left in `output`.
+        """
+        self._shell.write("<PYLL_TYPED|PyLLProfile(lambda(() %s\n) '%s)"
+                          "|PYLL_TYPED>" % (self._checked_expression(code),
+                                            mode))
+        _pay = self._read_reply()
+        if _pay['error'] is not None:
+            # The profiler itself failed
+            self._output, _exec_error = self._format_payload(
+                dict(_pay, result=None))
+            raise VirtuosoExceptions(_exec_error or
+                                     ("Error", 1, _pay['error']))
+        _summary, _ok, _value = from_json(_pay['result'])
+        if _ok:
+            _pay = dict(_pay, result=_value)
+        else:
+            _pay = dict(_pay, error=_value, result=None)
+        self._output, _exec_error = self._format_payload(_pay)
+        if not _ok and _exec_error is None:
+            _exec_error = ("Error", 1, _value)
+        return _summary, _exec_error
+
+    def fetch_array(self, expression):
+        """
+        Return the numeric value of *expression* as a NumPy array.
+
+        *expression* may evaluate to a waveform (its Y vector is used), a
+        drVector or a list of numbers. The values arrive as packed doubles,
+        and the returned array is a read-only view of the received data.
+        """
+        import numpy
+        self._shell.write("<PYLL_FETCH|" + expression + "|PYLL_FETCH>")
+        try:
+            _header, _values = self._shell.read_frames(self.timeout)
+        except VirtuosoTimeout:
+            self.interrupt()
+            raise
+        self._output, _exec_error = self._format_payload(
+            json.loads(_header.decode()))
+        if _exec_error is not None:
+            raise VirtuosoExceptions(_exec_error)
+        return numpy.frombuffer(_values, dtype='<f8')
+
+    @property
+    def pool(self):
+        """
+        Pool of all PyLL servers, connected on first use
+        """
+        if self._pool is None:
+            from .pool import VirtuosoPool
+            self._pool = VirtuosoPool()
+        return self._pool
+
+    def map(self, expressions):
+        """
+        Evaluate independent expressions in parallel on the server pool.
+
+        Returns a list of (output, error) tuples in the order of
+        *expressions*, where error is None or (etype, evalue, tb).
+        """
+        _exprs = [self._checked_expression(_expr) for _expr in expressions]
+        return [self._format_payload(_payload) for _payload in
+                self.pool.map(_exprs, self.timeout)]
+
+    def get_matches(self, code):
+        """
+        Return the completions for the end of *code*, the cell up to the
+        cursor, and the text they replace.
+
+        Nothing is offered inside strings and comments. '?' completes the
+        keyword arguments of the enclosing call, '->' and '~>' the attributes
+        of the object before them, and names complete to functions and
+        variables known to dfII or bound in the notebook.
+        """
+        self._complete_lexer = Lexer.extend(self._complete_lexer, code)
+        _lexer = self._complete_lexer
+        if not _lexer.tokens or _lexer.state() != 'code':
+            return [], ''
+        _last = _lexer.tokens[-1]
+        if _last.kind == 'keyword' or _last.text == '?':
+            return self._keyword_matches(_lexer, _last.text), _last.text
+        _code = _lexer.code_tokens()
+        if _last.kind == 'name':
+            _token = _last.text
+            _code.pop()
+        elif _last.kind == 'operator':
+            _token = ''
+        else:
+            return [], ''
+        if _code and _code[-1].text in ('->', '~>'):
+            return self._attribute_matches(_lexer, _code, _token), _token
+        if not _token:
+            return [], ''
+        _local = self._local_names.union(_lexer.definitions()[0])
+        _matches = sorted(_name for _name in _local
+                          if _name.startswith(_token) and _name != _token)
+        return (_matches + [_name for _name in
+                            self.completions.starts_with(_token)
+                            if _name not in _local], _token)
+
+    def _keyword_matches(self, lexer, prefix):
+        # '?key' arguments of the function called where *lexer* ends, from
+        # the procedures of the notebook or the function's help text
+        _name = lexer.call_name()
+        if _name is None:
+            return []
+        _keywords = lexer.definitions()[1].get(_name) or \
+            self._local_keywords.get(_name)
+        if _keywords is None:
+            if self._info_cache.get(_name) is None:
+                self.get_info(_name)
+            _keywords = self._opt_keyword_re.findall(
+                self._info_cache.get(_name)[0])
+        _matches = []
+        for _keyword in _keywords:
+            if _keyword.startswith(prefix) and _keyword not in _matches:
+                _matches.append(_keyword)
+        return _matches
+
+    def _attribute_matches(self, lexer, code, prefix):
+        # Attributes of the object whose expression ends code[:-1]; only
+        # names, indexing and the side-effect free self._accessors are
+        # evaluated to find it
+        _end = len(code) - 1
+        _start = _end - 1
+        while _start >= 0:
+            _token = code[_start]
+            if _token.kind == 'close':
+                _depth = 0
+                while _start >= 0:
+                    if code[_start].kind == 'close':
+                        _depth += 1
+                    elif code[_start].kind == 'open':
+                        _depth -= 1
+                        if _depth == 0:
+                            break
+                    _start -= 1
+                if _start > 0 and code[_start - 1].kind == 'name':
+                    _start -= 1
+            elif _token.kind != 'name':
+                return []
+            if _start >= 2 and code[_start - 1].text in ('->', '~>'):
+                _start -= 2
+            else:
+                break
+        if _start < 0:
+            return []
+        _object = code[_start:_end]
+        for _index, _token in enumerate(_object):
+            if _token.kind == 'operator' and _token.text in ('->', '~>'):
+                continue
+            if _token.kind not in ('name', 'number', 'open', 'close'):
+                return []
+            if _token.text in ('{', '}'):
+                return []
+            if _token.text == '(':
+                # The called function, f(...) or (f ...), must be harmless
+                if _index > 0 and _object[_index - 1].kind == 'name':
+                    _function = _object[_index - 1].text
+                elif _index + 1 < len(_object):
+                    _function = _object[_index + 1].text
+                else:
+                    return []
+                if _function not in self._accessors:
+                    return []
+        # Attribute lists only depend on objType, so dfII just reports the
+        # types of the objects and the attributes of types not seen before
+        _cmd = "PyLLAttributes(%s '(%s) %s)" % (
+            lexer.text[_object[0].start:code[_end].start].strip(),
+            ' '.join(json.dumps(_type) for _type in self._attribute_cache),
+            't' if code[_end].text == '~>' else 'nil')
+        try:
+            _types = self.evaluate(_cmd) or []
+        except VirtuosoExceptions:
+            return []  # Not an object
+        _attributes = []
+        for _type, _type_attributes in _types:
+            if _type is None:
+                _attributes.append(_type_attributes)
+            elif _type_attributes is None:
+                _attributes.append(self._attribute_cache.get(_type, []))
+            else:
+                self._attribute_cache[_type] = _type_attributes
+                _attributes.append(_type_attributes)
+        _matches = []
+        # '~>?' on a list of property lists gives one list for each
+        _pending = _attributes
+        while _pending:
+            _attribute = _pending.pop(0)
+            if isinstance(_attribute, list):
+                _pending[:0] = _attribute
+            elif hasattr(_attribute, 'startswith') and \
+                    _attribute.startswith(prefix) and \
+                    _attribute not in _matches:
+                _matches.append(str(_attribute))
+        return _matches
 
     def get_info(self, token):
         """
@@ -291,33 +1031,83 @@ class VirtuosoShell(object):
         # Make sure that only valid function/variable names are used
         if token.rstrip() != '':
             token = re.match(r'(\S+?)\s*$', token).group(1)
+        _cached = self._info_cache.get(token)
+        if _cached is not None:
+            return _cached[1]
         _cmd = 'help(%s)' % token
         self.run_raw(_cmd)
         _pay = json.loads(self._output)
         # Handle cases where no help is available
         if (_pay['info'] is None) or (_pay['result'] == "nil"):
-            return ""
+            _cached = ("", "")
         else:
-            return (self._pretty_introspection(_pay['info'], token))
+            _cached = (_pay['info'],
+                       self._pretty_introspection(_pay['info'], token))
+        self._info_cache.put(token, _cached)
+        return _cached[1]
 
-    def interrupt(self):
+    def heartbeat(self):
+        """
+        Check the server without connecting to it.
+
+        Returns the endpoint, the heartbeat's round trip in seconds and the
+        server's answer (see `VirtuosoShellClient.ping`), or None if there
+        is no connection; the last two are None if the server is silent.
+        """
+        if self._client is None or self._client.lost:
+            return None
+        _start = time.time()
+        _answer = self._client.ping()
+        if _answer is None:
+            return self._client.endpoint, None, None
+        return self._client.endpoint, time.time() - _start, _answer
+
+    def interrupt(self, stream=None):
         """
         Send an interrupt to the virtuoso shell
+
+        If dfII does not answer within `interrupt_grace` seconds, the
+        connection is reset so that the shell stays usable.
         """
-        #self._shell.sendintr()
-        #TODO: finish this
-        pass
+        if self._client is None or not self._client.pending:
+            return  # Nothing of ours is running
+        self._shell.interrupt()
+        try:
+            self._shell.read_stream(stream or (lambda _text: None),
+                                    self.interrupt_grace)
+        except (VirtuosoTimeout, zmq.ZMQError):
+            self._shell.reset()
+        except VirtuosoConnectionLost:
+            pass  # Nothing left to interrupt
 
-    def wait_ready(self):
+    def wait_ready(self, stream=None):
         """
         Wait for the dfII to reply to the previously submitted code
         """
-        self._output = self._shell.read_parsed()
+        try:
+            if stream is not None:
+                self._output = json.loads(self._shell.read_stream(
+                    stream, self.timeout))
+            else:
+                self._output = self._shell.read_parsed(self.timeout)
+        except VirtuosoTimeout:
+            self._output = ""
+            self.interrupt(stream)
+            raise
+        self.last_timing = {'round_trip': self._shell.last_round_trip,
+                            'server': self._shell.last_meta.get('timing')}
+        if isinstance(self._output, dict):
+            self.last_timing['skill'] = self._output.get('timing')
 
     def shutdown(self, restart):
         """
         Shutdown the shell; restart if requested
         """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._client is None:
+            return
         if restart:
             self._shell.close()
             self._shell.init()
@@ -0,0 +1,113 @@
+"""
+Per-cell latency breakdown across the kernel, ZMQ, PyLL server and dfII.
+"""
+import math
+
+# Stages in the order a request passes through them
+STAGES = [('kernel', 'Kernel'),
+          ('zmq', 'ZMQ transport'),
+          ('queue', 'Server queue'),
+          ('server', 'Server processing'),
+          ('virtuoso', 'dfII pipe + eval'),
+          ('pipe', 'dfII IPC pipe'),
+          ('eval', 'SKILL evaluation'),
+          ('total', 'Total')]
+
+
+def breakdown(total, round_trip, server=None, skill=None):
+    """
+    Split the time spent on a cell into stages.
+
+    *total* is the kernel's time for the cell and *round_trip* the client's
+    time from send to reply, both in seconds. *server* holds the server's
+    'queue', 'virtuoso' and 'server' times and *skill* the 'eval' time
+    measured by dfII, when they were reported.
+    """
+    _stages = {'total': total, 'kernel': total - round_trip}
+    if server:
+        _stages['zmq'] = round_trip - server['server']
+        _stages['queue'] = server['queue']
+        _stages['server'] = (server['server'] - server['queue'] -
+                             server['virtuoso'])
+        if skill:
+            _stages['pipe'] = server['virtuoso'] - skill['eval']
+            _stages['eval'] = skill['eval']
+        else:
+            _stages['virtuoso'] = server['virtuoso']
+    return _stages
+
+
+def format_time(seconds):
+    for _scale, _unit in ((1.0, 's'), (1e-3, 'ms'), (1e-6, 'us')):
+        if abs(seconds) >= _scale:
+            return '%.3g %s' % (seconds / _scale, _unit)
+    return '%.3g ns' % (seconds * 1e9)
+
+
+class LatencyHistogram(object):
+    """
+    Counts of latencies in power-of-two buckets from 1 us upwards
+    """
+    def __init__(self):
+        super(LatencyHistogram, self).__init__()
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        _bucket = max(0, int(math.ceil(math.log(max(seconds, 1e-6) / 1e-6,
+                                                2))))
+        self.counts[_bucket] = self.counts.get(_bucket, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of samples
+        """
+        _seen = 0
+        for _bucket in sorted(self.counts):
+            _seen += self.counts[_bucket]
+            if _seen >= fraction * self.count:
+                return 1e-6 * 2 ** _bucket
+        return 0.0
+
+
+class SessionTimings(object):
+    """
+    Latency breakdowns of all cells run in this session
+    """
+    def __init__(self):
+        super(SessionTimings, self).__init__()
+        self.last = None
+        self.histograms = dict((_stage, LatencyHistogram())
+                               for _stage, _name in STAGES)
+
+    def add(self, stages):
+        self.last = stages
+        for _stage, _seconds in stages.items():
+            self.histograms[_stage].add(max(_seconds, 0.0))
+
+    def format_last(self):
+        if self.last is None:
+            return 'No cells timed yet'
+        return '\n'.join('%-18s %10s' % (_name + ':',
+                                         format_time(self.last[_stage]))
+                         for _stage, _name in STAGES if _stage in self.last)
+
+    def format_histograms(self):
+        _lines = ['%-18s %6s %10s %10s %10s %10s' %
+                  ('Stage', 'cells', 'mean', 'p50 <=', 'p99 <=', 'max')]
+        for _stage, _name in STAGES:
+            _hist = self.histograms[_stage]
+            if _hist.count == 0:
+                continue
+            _lines.append('%-18s %6d %10s %10s %10s %10s' %
+                          (_name, _hist.count,
+                           format_time(_hist.sum / _hist.count),
+                           format_time(_hist.percentile(0.5)),
+                           format_time(_hist.percentile(0.99)),
+                           format_time(_hist.max)))
+        return '\n'.join(_lines)
@@ -0,0 +1,55 @@
+"""
+Python values of SKILL data serialized by 'PyLLToJSON'.
+"""
+
+
+class Symbol(str):
+    """
+    A SKILL symbol; compares equal to its name
+    """
+    def __repr__(self):
+        return 'Symbol(%s)' % str.__repr__(self)
+
+
+class SkillObject(object):
+    """
+    A SKILL value without a Python counterpart, such as a database object
+    """
+    def __init__(self, type, repr, obj_type=None):
+        super(SkillObject, self).__init__()
+        # SKILL type name, e.g. 'dbobject' or 'port'
+        self.type = type
+        # Printed form, e.g. 'db:0x1234abcd'
+        self.repr = repr
+        # objType of database objects, e.g. 'cellView'
+        self.obj_type = obj_type
+
+    def __repr__(self):
+        return '<SKILL %s %s>' % (self.obj_type or self.type, self.repr)
+
+
+def _key(value):
+    # Lists cannot be dictionary keys
+    if isinstance(value, list):
+        return tuple(_key(_item) for _item in value)
+    return value
+
+
+def from_json(value):
+    """
+    Convert the parsed JSON of a SKILL value to native Python data.
+
+    Lists become lists, tables dicts, symbols `Symbol` and other objects
+    `SkillObject`. nil is None and t is True.
+    """
+    if isinstance(value, list):
+        return [from_json(_item) for _item in value]
+    if not isinstance(value, dict):
+        return value
+    _type = value.get('type')
+    if _type == 'symbol':
+        return Symbol(value['name'])
+    if _type == 'table':
+        return dict((_key(from_json(_k)), from_json(_v))
+                    for _k, _v in value['items'])
+    return SkillObject(_type, value.get('repr'), value.get('objType'))